@@ -44,6 +44,18 @@ class WinterthurApp(OrgApp):
         # managed by the roadwork client
         return self.get_cache('roadwork', expiration_time=60 * 60 * 24)
 
+    @property
+    def streets_cache(self):
+        # remembers the downloaded streets directory files, the entries are
+        # refreshed by each daily update
+        return self.get_cache('streets', expiration_time=60 * 60 * 24 * 7)
+
+    @property
+    def daycare_cache(self):
+        # the daycares are cached by directory revision, so outdated entries
+        # are never read again and merely wait to expire
+        return self.get_cache('daycares', expiration_time=60 * 60 * 24)
+
     @cached_property
     def roadwork_client(self):
         config = RoadworkConfig.lookup()
@@ -53,7 +65,9 @@ class WinterthurApp(OrgApp):
             hostname=config.hostname,
             endpoint=config.endpoint,
             username=config.username,
-            password=config.password
+            password=config.password,
+            connect_timeout=config.connect_timeout,
+            timeout=config.timeout
         )
 
     def static_file(self, path):
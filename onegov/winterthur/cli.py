@@ -1,13 +1,23 @@
 import click
+import csv
 import json
+import os
 import sedate
 import shutil
 
 from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+from multiprocessing import Pool
 from onegov.core.cli import command_group
 from onegov.core.crypto import random_token
 from onegov.core.csv import CSVFile
 from onegov.file.utils import as_fileintent
+from onegov.winterthur.daycare import DaycareSubsidyCalculator
+from onegov.winterthur.daycare import Services
+from onegov.winterthur.daycare import SERVICE_DAYS
+from onegov.winterthur.daycare import SUBSIDY_ENGINES
+from onegov.winterthur.daycare import round_to
 from onegov.winterthur.models import MissionReport
 from onegov.winterthur.models import MissionReportFile
 from onegov.winterthur.models import MissionReportVehicle
@@ -264,3 +274,193 @@ def import_mission_vehicles(import_file, replace, match):
             request.session.add(vehicle)
 
     return handle_import
+
+
+# the state of the daycare simulation worker processes
+simulation = {}
+
+
+def init_simulation(settings, daycares, services, engine):
+    simulation['settings'] = settings
+    simulation['daycares'] = daycares
+    simulation['services'] = services
+    simulation['engine'] = SUBSIDY_ENGINES[engine]
+    simulation['engines'] = {}
+
+
+def simulate_household(row):
+    """ Calculates the monthly shares of the given household (a CSV row).
+
+    The services are given as a list of service ids and days, for example::
+
+        ganzer-tag-inkl-mitagessen: mo, di; vor-oder-nachmittag-...: mi
+
+    """
+
+    # csv.DictReader stores surplus values under None
+    surplus = row.pop(None, None)
+
+    def value(column):
+        # the missing values of short rows are None
+        if row.get(column) is None:
+            raise ValueError(f"Missing value: {column}")
+
+        return row[column].strip()
+
+    try:
+        if surplus:
+            raise ValueError(f"Surplus values: {', '.join(surplus)}")
+
+        daycare = simulation['daycares'][value('daycare')]
+
+        if daycare is None:
+            raise ValueError(f"Ambiguous daycare: {value('daycare')}")
+
+        services = Services(simulation['services'])
+
+        for selection in value('services').split(';'):
+            if not selection.strip():
+                continue
+
+            service_id, days = selection.split(':')
+            service_id = service_id.strip()
+
+            if service_id not in services.available:
+                raise ValueError(f"Unknown service: {service_id}")
+
+            for day in days.split(','):
+                day = SERVICE_DAYS[day.strip().lower()[:2]]
+                services.select(service_id, day)
+
+        if daycare.title not in simulation['engines']:
+            simulation['engines'][daycare.title] = simulation['engine'](
+                simulation['settings'], daycare)
+
+        engine = simulation['engines'][daycare.title]
+
+        parent, city = engine.shares(
+            income=Decimal(value('income')),
+            wealth=Decimal(value('wealth')),
+            services_total=services.total,
+            rebate=value('rebate').lower() in ('1', 'true', 'ja')
+        )[2:]
+
+    except (
+        AttributeError,
+        InvalidOperation,
+        KeyError,
+        TypeError,
+        ValueError,
+    ) as e:
+        return {**row, 'error': f'{e.__class__.__name__}: {e}'}
+
+    parent = round_to(parent, '0.05')
+    city = round_to(city, '0.05')
+
+    return {
+        **row,
+        'parent_share_per_month': parent,
+        'city_share_per_month': city,
+        'total_per_month': parent + city,
+        'error': '',
+    }
+
+
+@cli.command(
+    name='simulate-daycare-subsidies', context_settings={'singular': True})
+@click.option('--input-file', type=click.Path(exists=True), required=True)
+@click.option('--output-file', type=click.Path(exists=False), required=True)
+@click.option('--processes', type=int, default=None)
+@click.option('--batch-size', type=int, default=10_000)
+@click.option('--engine', type=click.Choice(tuple(SUBSIDY_ENGINES)),
+              default='decimal')
+def simulate_daycare_subsidies(input_file, output_file, processes, batch_size,
+                               engine):
+    """ Calculates the daycare subsidies of a CSV of anonymized households,
+    using the current settings and daycares.
+
+    The CSV needs the following columns:
+
+    \b
+    * income: The taxable income.
+    * wealth: The taxable wealth.
+    * daycare: The title of the daycare.
+    * services: The used services (e.g. "ganzer-tag-inkl-mitagessen: mo, di").
+    * rebate: 1 if a rebate is applied, 0 otherwise.
+
+    The households are read, calculated and written in batches, using
+    a pool of processes. The result contains all columns of the input, as
+    well as the monthly shares. At the end, the total city share is shown.
+
+    """
+
+    processes = processes or os.cpu_count()
+
+    def handle_simulation(request, app):
+        calculator = DaycareSubsidyCalculator(request.session)
+
+        # the households of daycares sharing a title cannot be calculated
+        daycares = dict(calculator.daycares_by_title)
+
+        for title in calculator.ambiguous_titles:
+            click.echo(f"Ambiguous daycare: {title}", err=True)
+            daycares[title] = None
+
+        initargs = (
+            calculator.settings,
+            daycares,
+            calculator.settings.services,
+            engine
+        )
+
+        households = 0
+        errors = 0
+        city_share = Decimal('0')
+        parent_share = Decimal('0')
+
+        # without a header, there is nothing to simulate
+        with open(input_file, 'r', newline='') as i:
+            if not csv.DictReader(i).fieldnames:
+                raise click.ClickException(f"{input_file} is empty")
+
+        with open(input_file, 'r', newline='') as i, \
+                open(output_file, 'w', newline='') as o, \
+                Pool(processes, init_simulation, initargs) as pool:
+
+            reader = csv.DictReader(i)
+            writer = csv.DictWriter(o, fieldnames=(*reader.fieldnames, *(
+                'parent_share_per_month',
+                'city_share_per_month',
+                'total_per_month',
+                'error'
+            )), extrasaction='ignore')
+            writer.writeheader()
+
+            while True:
+                batch = tuple(islice(reader, batch_size))
+
+                if not batch:
+                    break
+
+                chunksize = max(1, len(batch) // (processes * 4))
+
+                for result in pool.imap(
+                        simulate_household, batch, chunksize=chunksize):
+
+                    households += 1
+
+                    if result['error']:
+                        errors += 1
+                    else:
+                        city_share += result['city_share_per_month']
+                        parent_share += result['parent_share_per_month']
+
+                    writer.writerow(result)
+
+        click.echo(f"Households: {households}")
+        click.echo(f"Errors: {errors}")
+        click.echo(f"Parent share per month: {parent_share} CHF")
+        click.echo(f"City share per month: {city_share} CHF")
+        click.echo(f"City share per year: {city_share * 12} CHF")
+
+    return handle_simulation
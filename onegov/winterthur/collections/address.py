@@ -1,19 +1,274 @@
-from concurrent.futures import ThreadPoolExecutor
-from io import BytesIO
+import csv
+import pycurl
+import re
+import transaction
+
+from codecs import BOM_UTF8, getincrementaldecoder
+from collections import namedtuple
+from hashlib import sha256
+from io import StringIO
+from itertools import chain, groupby, islice
 from onegov.core.collection import GenericCollection
-from onegov.core.csv import CSVFile
+from onegov.winterthur import log
 from onegov.core.orm import as_selectable
 from onegov.winterthur.models import WinterthurAddress
-from pycurl import Curl
+from queue import Empty, Full, Queue
 from sqlalchemy import select, func
+from threading import Event, Thread
+from uuid import uuid4
+from zope.sqlalchemy import mark_changed
 
 HOST = 'https://stadt.winterthur.ch'
 STREETS = f'{HOST}/_static/strassenverzeichnis/gswpl_strver_str.csv'
 ADDRESSES = f'{HOST}/_static/strassenverzeichnis/gswpl_strver_adr.csv'
 
 
+class CSVStream(object):
+    """ Downloads a CSV file in a background thread and yields its lines
+    while they are received, like :attr:`onegov.core.csv.CSVFile.lines`.
+
+    The download is paused until the received chunks have been read, so
+    only a few of them are held in memory at any time, regardless of the
+    size of the file. As the time this takes depends on the reader, the
+    download is not limited in time, but aborted if less than
+    `low_speed_limit` bytes per second are received for `low_speed_time`
+    seconds.
+
+    Unless given, the encoding (UTF-8 or Latin-1) and the delimiter are
+    detected. The headers are normalised to valid identifiers. Rows with
+    fewer or more values than headers are skipped and reported in
+    :attr:`malformed`.
+
+    """
+
+    #: the number of chunks held between the download and the reader
+    buffer_size = 16
+
+    #: the delimiters which are detected
+    delimiters = ';,\t|'
+
+    def __init__(self, url, headers=(), encoding=None, delimiter=None,
+                 connect_timeout=10, low_speed_limit=1024, low_speed_time=60):
+
+        self.url = url
+        self.encoding = encoding
+        self.delimiter = delimiter
+
+        self.status = None
+        self.headers = {}
+        self.error = None
+        self.digest = None
+
+        # the line numbers of the skipped rows
+        self.malformed = []
+
+        self.chunks = Queue(maxsize=self.buffer_size)
+        self.ready = Event()
+        self.closed = False
+
+        self.curl = pycurl.Curl()
+        self.curl.setopt(pycurl.URL, url)
+        self.curl.setopt(pycurl.HTTPHEADER, list(headers))
+        self.curl.setopt(pycurl.WRITEFUNCTION, self.on_data)
+        self.curl.setopt(pycurl.HEADERFUNCTION, self.on_header)
+        self.curl.setopt(pycurl.NOSIGNAL, 1)
+        self.curl.setopt(pycurl.CONNECTTIMEOUT, connect_timeout)
+        self.curl.setopt(pycurl.LOW_SPEED_LIMIT, low_speed_limit)
+        self.curl.setopt(pycurl.LOW_SPEED_TIME, low_speed_time)
+
+        self.thread = Thread(target=self.download, daemon=True)
+        self.thread.start()
+
+    @property
+    def etag(self):
+        return self.headers.get('etag')
+
+    @property
+    def modified(self):
+        return self.headers.get('last-modified')
+
+    def download(self):
+        try:
+            self.curl.perform()
+        except pycurl.error as e:
+            self.error = e
+        finally:
+            self.curl.close()
+            self.ready.set()
+            self.put(None)
+
+    def on_header(self, line):
+        line = line.decode('iso-8859-1')
+
+        if line.startswith('HTTP/'):
+            self.status = int(line.split()[1])
+            self.headers.clear()
+
+        elif ':' in line:
+            key, value = line.split(':', 1)
+            self.headers[key.strip().lower()] = value.strip()
+
+    def on_data(self, chunk):
+        self.ready.set()
+
+        # returning anything but the length of the chunk aborts the download
+        if not self.put(chunk):
+            return 0
+
+    def put(self, chunk):
+        while not self.closed:
+            try:
+                self.chunks.put(chunk, timeout=0.1)
+            except Full:
+                continue
+            else:
+                return True
+
+        return False
+
+    def wait(self):
+        """ Waits for the response headers and returns the status code. """
+
+        self.ready.wait()
+
+        if self.error and not self.closed:
+            raise RuntimeError(f"Failed to download {self.url}: {self.error}")
+
+        return self.status
+
+    def close(self):
+        self.closed = True
+
+        # unblock the download, which stops once it sees the closed flag
+        try:
+            while True:
+                self.chunks.get_nowait()
+        except Empty:
+            pass
+
+    @staticmethod
+    def detect_encoding(chunk):
+        """ Returns the encoding of the given chunk, which is either UTF-8 or
+        Latin-1 (which decodes anything).
+
+        """
+        if chunk.startswith(BOM_UTF8):
+            return 'utf-8-sig'
+
+        try:
+            chunk.decode('utf-8')
+        except UnicodeDecodeError as e:
+            # a character may be split between two chunks
+            if e.reason != 'unexpected end of data':
+                return 'iso-8859-1'
+
+        return 'utf-8'
+
+    def text(self):
+        decoder = self.encoding and getincrementaldecoder(self.encoding)()
+        digest = sha256()
+        rest = ''
+
+        while True:
+            chunk = self.chunks.get()
+
+            if chunk is None:
+                break
+
+            digest.update(chunk)
+
+            # the encoding is detected once it matters, ascii is the same
+            # in both of them
+            if not decoder and chunk and max(chunk) > 127:
+                self.encoding = self.detect_encoding(chunk)
+                decoder = getincrementaldecoder(self.encoding)()
+
+            text = decoder.decode(chunk) if decoder else chunk.decode('ascii')
+
+            *lines, rest = (rest + text).split('\n')
+
+            for line in lines:
+                yield line + '\n'
+
+        if self.error:
+            raise RuntimeError(f"Failed to download {self.url}: {self.error}")
+
+        if decoder:
+            rest += decoder.decode(b'', final=True)
+
+        if rest:
+            yield rest
+
+        self.digest = digest.hexdigest()
+
+    def detect_delimiter(self, header):
+        return max(self.delimiters, key=header.count)
+
+    @property
+    def lines(self):
+        text = self.text()
+        header = next(text, None)
+
+        if not header:
+            return
+
+        delimiter = self.delimiter or self.detect_delimiter(header)
+        rows = csv.reader(chain((header, ), text), delimiter=delimiter)
+
+        Line = namedtuple('Line', map(as_identifier, next(rows)), rename=True)
+
+        for row in rows:
+            if not row:
+                continue
+
+            if len(row) != len(Line._fields):
+                self.malformed.append(rows.line_num)
+                continue
+
+            yield Line(*row)
+
+        if self.malformed:
+            lines = ', '.join(str(n) for n in self.malformed[:10])
+            log.warning(
+                f"Skipped {len(self.malformed)} malformed rows of "
+                f"{self.url} (lines {lines})")
+
+
+def as_identifier(header):
+    """ Normalises the given CSV header to a valid identifier. """
+
+    identifier = re.sub(r'\W+', '_', header.strip().lower())
+    return identifier.lstrip('0123456789_').rstrip('_')
+
+
 class AddressCollection(GenericCollection):
 
+    #: the columns of the rows written by :meth:`copy_rows`
+    copy_columns = (
+        'id',
+        'street_id',
+        'street',
+        'house_number',
+        'house_extra',
+        'zipcode',
+        'zipcode_extra',
+        'place',
+        'district',
+        'neighbourhood',
+    )
+
+    #: the time to connect to the server of the streets directory, and the
+    #: time after which a stalled download is aborted, in seconds
+    connect_timeout = 10
+    low_speed_time = 60
+
+    def __init__(self, session, cache=None):
+        self.session = session
+
+        # stores the etag, last-modified date and digest of each url, as
+        # well as the listing of the streets
+        self.cache = cache
+
     @property
     def model_class(self):
         return WinterthurAddress
@@ -33,67 +288,346 @@ class AddressCollection(GenericCollection):
 
         return self.session.execute(select(query.c))
 
-    def update(self, streets=STREETS, addresses=ADDRESSES):
-        self.delete_existing()
-        self.import_from_csv(*self.load_urls(streets, addresses))
+    def listing(self, key, link):
+        """ Returns the streets grouped by their first letter, together with
+        the link to each street::
+
+            (('A', (('Ackeretstrasse', 'https://...'), ...)), ...)
+
+        As the links depend on the host, the listing is cached for each
+        given key (e.g. the application url), until the addresses are
+        changed through this collection.
+
+        """
+
+        def create():
+            return tuple(
+                (letter, tuple((s.street, link(s.street)) for s in streets))
+                for letter, streets in groupby(
+                    self.streets(), lambda s: s.letter)
+            )
+
+        if self.cache is None:
+            return create()
+
+        revision = self.cache.get_or_create(
+            'listing-revision', lambda: uuid4().hex)
+
+        # an empty directory is not cached, as it has yet to be imported
+        return self.cache.get_or_create(
+            f'listing-{revision}-{key}', create, should_cache_fn=bool)
+
+    def invalidate_listing(self):
+        # a new revision before the commit would be filled with the old data
+        if self.cache is not None:
+            self.after_commit(
+                lambda: self.cache.set('listing-revision', uuid4().hex))
+
+    def update(self, streets=STREETS, addresses=ADDRESSES, full=False):
+        """ Updates the streets directory from the given urls.
+
+        By default, only the changed addresses are written (see
+        :meth:`sync_from_csv`). With ``full=True`` all addresses are
+        deleted and imported again.
+
+        The files are streamed into the database while they are being
+        downloaded. If a cache was given, they are only downloaded if they
+        changed since the last update, and no changes are written if
+        neither did.
+
+        Returns the number of added, updated and deleted addresses.
+
+        """
+        urls = (streets, addresses)
+        streams = list(self.open_urls(*urls, conditional=not full))
+
+        if all(s is None for s in streams):
+            return {'added': 0, 'updated': 0, 'deleted': 0}
+
+        try:
+            # if only one of the files changed, we still need the other one
+            for ix, (url, stream) in enumerate(zip(urls, streams)):
+                if stream is None:
+                    streams[ix] = self.open_url(url, conditional=False)
+
+            if full:
+                deleted = self.delete_existing()
+                added = self.import_from_csv(*streams)
+
+                changes = {'added': added, 'updated': 0, 'deleted': deleted}
+            else:
+                self.stage(self.rows_from_csv(*streams))
+
+                # the digests are known once the files have been read
+                if all(self.is_unchanged(u, s) for u, s in zip(urls, streams)):
+                    self.discard_stage()
+                    changes = {'added': 0, 'updated': 0, 'deleted': 0}
+                else:
+                    changes = self.apply_stage()
+        finally:
+            for stream in streams:
+                if stream is not None:
+                    stream.close()
+
+        # the downloads are only remembered once the changes are committed,
+        # a rolled back update must not be skipped the next time
+        def remember():
+            for url, stream in zip(urls, streams):
+                self.remember(url, stream)
+
+        self.after_commit(remember)
+
+        return changes
 
     def delete_existing(self):
-        for address in self.query():
-            self.session.delete(address)
+        self.session.flush()
+        self.invalidate_listing()
+
+        return self.query().delete(synchronize_session=False)
 
     def import_from_csv(self, streets, addresses):
-        streets = {s.strc: s.bez for s in streets.lines}
+        """ Imports the given streets and addresses.
+
+        The rows are not loaded into the ORM, but written in batches using
+        COPY, so this is fast and uses little memory, even with all
+        addresses of Winterthur.
+
+        Returns the number of imported addresses.
+
+        """
+        self.invalidate_listing()
+        return self.copy_rows(self.rows_from_csv(streets, addresses))
+
+    def sync_from_csv(self, streets, addresses):
+        """ Synchronises the existing addresses with the given streets and
+        addresses, keyed on their id (``einid``).
+
+        The rows are copied into a temporary table first. Afterwards, only
+        the addresses which were added, changed or removed are written,
+        which leaves the table alone on the days where nothing changed.
+
+        Returns the number of added, updated and deleted addresses.
+
+        """
+        self.stage(self.rows_from_csv(streets, addresses))
+        return self.apply_stage()
+
+    def stage(self, rows):
+        """ Copies the given rows into a temporary table, to be applied to
+        the addresses with :meth:`apply_stage`.
+
+        """
+        self.session.flush()
+
+        self.session.execute("""
+            CREATE TEMPORARY TABLE winterthur_addresses_import
+            (LIKE winterthur_addresses INCLUDING DEFAULTS)
+            ON COMMIT DROP
+        """)
+
+        self.copy_rows(rows, table='winterthur_addresses_import')
+
+    def discard_stage(self):
+        self.session.execute("DROP TABLE winterthur_addresses_import")
+
+    def apply_stage(self):
+        """ Writes the addresses which were added, changed or removed in the
+        temporary table and drops it.
+
+        """
+        columns = ', '.join(self.copy_columns)
+        current = ', '.join(f'a.{c}' for c in self.copy_columns)
+        values = ', '.join(f'i.{c}' for c in self.copy_columns)
+        changes = ', '.join(f'{c} = i.{c}' for c in self.copy_columns[1:])
+
+        deleted = self.session.execute("""
+            DELETE FROM winterthur_addresses a
+            WHERE NOT EXISTS (
+                SELECT 1 FROM winterthur_addresses_import i WHERE i.id = a.id
+            )
+        """).rowcount
+
+        updated = self.session.execute(f"""
+            UPDATE winterthur_addresses a SET {changes}
+            FROM winterthur_addresses_import i
+            WHERE a.id = i.id AND ({current}) IS DISTINCT FROM ({values})
+        """).rowcount
+
+        added = self.session.execute(f"""
+            INSERT INTO winterthur_addresses ({columns})
+            SELECT {values} FROM winterthur_addresses_import i
+            WHERE NOT EXISTS (
+                SELECT 1 FROM winterthur_addresses a WHERE a.id = i.id
+            )
+        """).rowcount
+
+        self.discard_stage()
+        mark_changed(self.session)
 
+        if added or updated or deleted:
+            self.invalidate_listing()
+
+        return {'added': added, 'updated': updated, 'deleted': deleted}
+
+    def rows_from_csv(self, streets, addresses):
+        """ Yields the rows of the given streets and addresses, in the order
+        of :attr:`copy_columns`.
+
+        """
+        streets = {s.strc: s.bez for s in streets.lines}
         addressless = set(streets.keys())
-        max_id = 0
 
         for r in addresses.lines:
             addressless.discard(r.strc)
 
-            address = WinterthurAddress()
-            address.id = int(r.einid)
-            address.street_id = int(r.strc)
-            address.street = streets[r.strc]
-            address.house_number = int(r.hnr)
-            address.house_extra = r.hnrzu
-            address.zipcode = int(r.plz)
-            address.zipcode_extra = r.plzzu
-            address.place = r.ort
-            address.district = r.kreisname
-            address.neighbourhood = r.quartiername
+            yield (
+                int(r.einid),
+                int(r.strc),
+                streets[r.strc],
+                int(r.hnr),
+                r.hnrzu,
+                int(r.plz),
+                int(r.plzzu) if r.plzzu else None,
+                r.ort,
+                r.kreisname,
+                r.quartiername,
+            )
 
-            self.session.add(address)
+        # some streets do not have addresses -> we write a special record
+        # for those streets so they still show up in our UI
+        #
+        # not the most elegant solution, but better than introducing a
+        # separate table at least for now
+        #
+        # those records use the negative street id as their id, so they
+        # stay the same from one update to the next
+        for key in sorted(addressless, key=int):
+            yield (-int(key), int(key), streets[key], -1, None, -1, None, '',
+                   '', '')
 
-            max_id = max(max_id, address.id)
+    def copy_rows(self, rows, table='winterthur_addresses',
+                  batch_size=10_000):
+        """ Writes the given address rows to the given table, using COPY.
 
-        # some streets do not have addresses -> we write a special record for
-        # those streets so they still show up in our UI
-        #
-        # not the most elegant solution, but better than introducing a separate
-        # table at least for now
-        for id, key in enumerate(addressless, start=max_id + 1):
-            address = self.model_class.as_addressless(int(key), streets[key])
-            address.id = id
+        Each row is a tuple in the order of :attr:`copy_columns`. Returns
+        the number of rows written.
 
-            self.session.add(address)
+        """
 
         self.session.flush()
 
-    def load_urls(self, *urls):
-        with ThreadPoolExecutor(max_workers=2) as executor:
-            futures = (executor.submit(self.load_url, url) for url in urls)
-            return tuple(f.result() for f in futures)
+        cursor = self.session.connection().connection.cursor()
+        statement = f"""
+            COPY {table} ({', '.join(self.copy_columns)})
+            FROM STDIN WITH (FORMAT csv, NULL '\\N')
+        """
+
+        rows = (
+            tuple('\\N' if value is None else value for value in row)
+            for row in rows
+        )
+
+        count = 0
+
+        while True:
+            batch = StringIO()
+
+            writer = csv.writer(batch, lineterminator='\n')
+            writer.writerows(islice(rows, batch_size))
+
+            if not batch.tell():
+                break
+
+            batch.seek(0)
+            cursor.copy_expert(statement, batch)
+
+            count += cursor.rowcount
+
+        mark_changed(self.session)
+
+        return count
+
+    def open_urls(self, *urls, conditional=True):
+        streams = []
+
+        try:
+            for url in urls:
+                streams.append(self.open_url(url, conditional))
+        except Exception:
+            for stream in streams:
+                if stream is not None:
+                    stream.close()
+            raise
+
+        return tuple(streams)
+
+    def open_url(self, url, conditional=True):
+        """ Opens a :class:`CSVStream` of the given url.
+
+        If the url was downloaded before, the request is conditional and
+        None is returned if the file was not modified since.
+
+        """
+        known = conditional and self.cache is not None and self.cache.get(url)
+        headers = ()
+
+        if known:
+            headers = [
+                f'{key}: {value}' for key, value in (
+                    ('If-None-Match', known['etag']),
+                    ('If-Modified-Since', known['modified'])
+                ) if value
+            ]
+
+        stream = CSVStream(
+            url, headers,
+            connect_timeout=self.connect_timeout,
+            low_speed_time=self.low_speed_time
+        )
+
+        status = stream.wait()
+
+        if status == 304 and known:
+            stream.close()
+            return None
+
+        if status != 200:
+            stream.close()
+            raise RuntimeError(f"Failed to download {url}: {status}")
+
+        return stream
+
+    def is_unchanged(self, url, stream):
+        """ Returns True if the given stream has the same content as the one
+        remembered during the last update.
+
+        """
+        known = self.cache is not None and self.cache.get(url)
+
+        if not known:
+            return False
+
+        return stream.digest == known['digest']
+
+    def remember(self, url, stream):
+        if self.cache is not None:
+            self.cache.set(url, {
+                'etag': stream.etag,
+                'modified': stream.modified,
+                'digest': stream.digest
+            })
+
+    def after_commit(self, callback):
+        """ Calls the given callback once the current transaction has been
+        committed successfully.
 
-    def load_url(self, url):
-        buffer = BytesIO()
+        """
 
-        c = Curl()
-        c.setopt(c.URL, url)
-        c.setopt(c.WRITEDATA, buffer)
-        c.perform()
-        c.close()
+        def hook(success):
+            if success:
+                callback()
 
-        return CSVFile(buffer)
+        transaction.get().addAfterCommitHook(hook)
 
 
 class AddressSubsetCollection(GenericCollection):
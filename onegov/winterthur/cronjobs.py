@@ -1,7 +1,28 @@
+from onegov.winterthur import log
 from onegov.winterthur.app import WinterthurApp
 from onegov.winterthur.collections import AddressCollection
+from onegov.winterthur.roadwork import RoadworkCollection
+from onegov.winterthur.roadwork import RoadworkError
 
 
 @WinterthurApp.cronjob(hour=15, minute=50, timezone='Europe/Zurich')
 def update_streets_directory(request):
-    AddressCollection(request.session).update()
+    addresses = AddressCollection(
+        request.session, cache=request.app.streets_cache)
+
+    changes = addresses.update()
+
+    log.info(
+        "Updated streets directory: {added} added, {updated} updated, "
+        "{deleted} deleted".format(**changes))
+
+
+@WinterthurApp.cronjob(hour='*', minute='*/5', timezone='Europe/Zurich')
+def warm_roadwork_cache(request):
+    try:
+        client = request.app.roadwork_client
+    except RoadworkError:
+        # there is no pdb configuration on this host
+        return
+
+    RoadworkCollection(client).warm()
@@ -1,20 +1,33 @@
 import chameleon
+import hashlib
+import hmac
+import os
 import textwrap
 import yaml
 
 from babel.numbers import format_decimal
+from bisect import bisect_right
 from cached_property import cached_property
+from collections import Counter
 from collections import defaultdict
+from collections import namedtuple
 from collections import OrderedDict
-from decimal import Decimal, localcontext
+from decimal import Decimal, ROUND_CEILING, getcontext, localcontext
+from functools import lru_cache
+from itertools import repeat
 from onegov.core.utils import Bunch
 from onegov.core.utils import normalize_for_url
 from onegov.directory import DirectoryCollection
+from onegov.directory import DirectoryEntry
 from onegov.directory import DirectoryEntryCollection
 from onegov.form import Form
 from onegov.org.models import Organisation
 from onegov.winterthur import _
 from ordered_set import OrderedSet
+from sqlalchemy import func
+from threading import Lock
+from time import monotonic
+from types import MappingProxyType
 from wtforms.fields import Field, BooleanField, SelectField
 from wtforms.fields.html5 import DecimalField
 from wtforms.validators import NumberRange, InputRequired, ValidationError
@@ -44,12 +57,27 @@ SERVICE_DAYS_LABELS = {
 # http://babel.pocoo.org/en/latest/numbers.html#pattern-syntax
 FORMAT = '#,##0.00########'
 
+ZERO = Decimal('0')
+CENTS = Decimal('0.01')
+HUNDRED = Decimal('100')
+HALF = Decimal('0.5')
+
+
+@lru_cache(maxsize=16)
+def quantizer(places):
+    return Decimal(f'0.{"0" * (places - 1)}1')
+
+
+@lru_cache(maxsize=16)
+def rounding_step(precision):
+    return Decimal(precision)
+
 
 def round_to(n, precision):
     assert isinstance(precision, str)
 
-    precision = Decimal(precision)
-    correction = Decimal('0.5') if n >= 0 else Decimal('-0.5')
+    precision = rounding_step(precision)
+    correction = HALF if n >= 0 else -HALF
 
     return int(n / precision + correction) * precision
 
@@ -58,6 +86,10 @@ def format_precise(amount):
     if not amount:
         return '0.00'
 
+    # the default context already has the required precision
+    if getcontext().prec == 28:
+        return format_decimal(amount, format=FORMAT, locale='de_CH')
+
     with localcontext() as ctx:
         ctx.prec = 28
 
@@ -85,13 +117,30 @@ class Daycare(object):
         return Decimal(self.weeks) / Decimal('12')
 
 
+Service = namedtuple('Service', ('id', 'title', 'percentage', 'days'))
+
+
+@lru_cache(maxsize=32)
+def compile_services(definition):
+    """ Returns the services catalogue of the given definition. The catalogue
+    is immutable and shared between requests. As it is cached by definition,
+    changed settings lead to a new catalogue.
+
+    """
+    return MappingProxyType(OrderedDict(Services.parse_definition(definition)))
+
+
 class Services(object):
+    """ The services selected by a household, based on the shared catalogue
+    of available services.
+
+    """
 
     def __init__(self, definition):
         if definition:
-            self.available = OrderedDict(self.parse_definition(definition))
+            self.available = compile_services(definition)
         else:
-            self.available = OrderedDict()
+            self.available = MappingProxyType(OrderedDict())
 
         self.selected = defaultdict(set)
 
@@ -115,11 +164,12 @@ class Services(object):
             service_id = normalize_for_url(service['titel'])
             days = (d.strip() for d in service['tage'].split(','))
 
-            yield service_id, Bunch(
+            yield service_id, Service(
                 id=service_id,
                 title=service['titel'],
                 percentage=Decimal(service['prozent']),
-                days=OrderedSet(SERVICE_DAYS[d.lower()[:2]] for d in days),
+                days=tuple(OrderedSet(
+                    SERVICE_DAYS[d.lower()[:2]] for d in days)),
             )
 
     def select(self, service_id, day):
@@ -180,10 +230,10 @@ class Block(object):
             amount = Decimal('0')
 
         def limit_total(total):
-            return total.quantize(Decimal(f'0.{"0" * (total_places - 1)}1'))
+            return total.quantize(quantizer(total_places))
 
         def limit_amount(amount):
-            return amount.quantize(Decimal(f'0.{"0" * (amount_places - 1)}1'))
+            return amount.quantize(quantizer(amount_places))
 
         if operation is None:
             assert amount is not None
@@ -266,12 +316,19 @@ class DirectoryDaycareAdapter(object):
 
 class Settings(object):
 
-    def __init__(self, organisation):
-        settings = organisation.meta.get('daycare_settings', {})
+    def __init__(self, organisation=None, settings=None):
+        if settings is None:
+            settings = organisation.meta.get('daycare_settings', {})
 
         for key, value in settings.items():
             setattr(self, key, value)
 
+    @property
+    def version(self):
+        """ Returns a hash of the settings, which changes with them. """
+        settings = sorted((k, repr(v)) for k, v in self.__dict__.items())
+        return hashlib.sha1(repr(settings).encode('utf-8')).hexdigest()
+
     def is_valid(self):
         keys = (
             'directory',
@@ -293,19 +350,799 @@ class Settings(object):
         return True
 
     def factor(self, daycare):
-        min_day_rate = daycare.rate - self.min_rate
-        min_day_rate = min(min_day_rate, self.max_subsidy)
+        return subsidy_factor(
+            daycare.rate,
+            self.min_rate,
+            self.max_subsidy,
+            self.max_income,
+            self.min_income
+        )
+
+
+@lru_cache(maxsize=1024)
+def subsidy_factor(rate, min_rate, max_subsidy, max_income, min_income):
+    """ Returns the factor of a daycare with the given rate. As it is cached
+    by the settings it depends on, it is only computed once per version
+    of the settings.
+
+    """
+    min_day_rate = rate - min_rate
+    min_day_rate = min(min_day_rate, max_subsidy)
+
+    factor = min_day_rate / (max_income - min_income)
+    factor = factor.quantize(Decimal('0.000000001'))
+
+    return factor
+
+
+def broadcast(*columns):
+    """ Zips the given columns into rows, repeating scalar values.
+
+    For example::
+
+        broadcast((1, 2), 3) -> (1, 3), (2, 3)
+
+    All columns which are not scalars need to be of the same length.
+
+    """
+    scalars = (Decimal, int, float)
+
+    sizes = {len(c) for c in columns if not isinstance(c, scalars)}
+
+    if len(sizes) > 1:
+        raise ValueError("All columns must be of the same length")
+
+    size = sizes and sizes.pop() or 1
+
+    return zip(*(
+        isinstance(c, scalars) and repeat(c, size) or c for c in columns
+    ))
+
+
+class SubsidyEngine(object):
+    """ Calculates the parent and city shares of many households for a single
+    daycare and a single set of settings in one pass.
+
+    The shares are rounded exactly like the totals of
+    :meth:`DaycareSubsidyCalculator.calculate_precisely`, but none of the
+    blocks, results and notes are created. All values which only depend on
+    the daycare and the settings are computed once, up front.
+
+    """
+
+    def __init__(self, settings, daycare):
+        self.settings = settings
+        self.daycare = daycare
+
+        self.factor = settings.factor(daycare)
+        self.weeks_factor = daycare.factor
+        self.additional_rate = max(daycare.rate - settings.max_rate, 0)
+
+    def shares(self, income, wealth, services_total, rebate):
+        """ Returns the parent and city shares of a single household as a
+        tuple of decimals::
+
+            (
+                parent_share_per_day,
+                city_share_per_day,
+                parent_share_per_month,
+                city_share_per_month
+            )
+
+        The services_total is the total percentage of the used services
+        (see :attr:`Services.total`).
+
+        """
+
+        cfg = self.settings
+        rate = self.daycare.rate
+
+        # every operation is quantized, like it is done by Block.op
+        base = income.quantize(CENTS)
+        base += max(
+            (wealth - cfg.max_wealth) * cfg.wealth_premium / HUNDRED, 0)
+        base = max(base.quantize(CENTS), ZERO)
+        base = max((base - cfg.min_income).quantize(CENTS), ZERO)
+
+        gross = max((base * self.factor).quantize(CENTS), ZERO)
+        gross = (gross + cfg.min_rate).quantize(CENTS)
+        gross = max(min(gross, rate), ZERO).quantize(CENTS)
+
+        rebate = gross * cfg.rebate / 100 if rebate else 0
+
+        net = max(cfg.min_rate, gross - rebate)
+        net = max(net, ZERO).quantize(CENTS)
+
+        parent_per_day = (net + self.additional_rate).quantize(CENTS)
+        parent_per_day = max(parent_per_day, ZERO)
+
+        city_per_day = max(rate - parent_per_day, ZERO).quantize(CENTS)
+
+        parent_per_month = (parent_per_day * services_total / 100)
+        parent_per_month = parent_per_month.quantize(CENTS)
+        parent_per_month = (parent_per_month * self.weeks_factor)
+        parent_per_month = max(parent_per_month.quantize(CENTS), ZERO)
+
+        city_per_month = city_per_day * services_total / 100
+        city_per_month = (city_per_month * self.weeks_factor).quantize(CENTS)
+
+        return parent_per_day, city_per_day, parent_per_month, city_per_month
+
+    def calculate(self, incomes, wealths, services_totals, rebates):
+        """ Calculates the shares for all the given households.
+
+        Each parameter may either be a sequence of values (one per household)
+        or a single value used for all households. This makes it easy to
+        create income/wealth tables::
+
+            engine.calculate(
+                incomes=incomes,
+                wealths=Decimal('0'),
+                services_totals=Decimal('500'),
+                rebates=False)
+
+        The result contains a tuple for each share, in the order of the
+        given households.
+
+        """
+
+        rows = broadcast(incomes, wealths, services_totals, rebates)
+        columns = tuple(zip(*(self.shares(*row) for row in rows)))
+
+        if not columns:
+            columns = ((), (), (), ())
+
+        return Bunch(
+            parent_share_per_day=columns[0],
+            city_share_per_day=columns[1],
+            parent_share_per_month=columns[2],
+            city_share_per_month=columns[3],
+        )
+
+
+def to_fixed(value, places):
+    """ Returns the given value as integer, scaled by 10^places. Values which
+    cannot be represented exactly are rejected with a ValueError.
+
+    """
+    scaled = value * 10 ** places
+    fixed = int(scaled)
+
+    if fixed != scaled:
+        raise ValueError(f"{value} has more than {places} decimal places")
+
+    return fixed
+
+
+def divide_half_even(dividend, divisor):
+    """ Divides two integers, rounding half to even like Decimal.quantize.
+    The divisor must be positive.
+
+    """
+    quotient, remainder = divmod(dividend, divisor)
+    remainder *= 2
+
+    if remainder > divisor or (remainder == divisor and quotient & 1):
+        quotient += 1
+
+    return quotient
+
+
+def round_to_precision(coefficient, exponent, precision):
+    """ Rounds the given coefficient to the given number of significant
+    digits, like the decimal context does after each operation.
+
+    Returns the new coefficient and exponent.
+
+    """
+    digits = len(str(abs(coefficient)))
+
+    if digits > precision:
+        shift = digits - precision
+        coefficient = divide_half_even(coefficient, 10 ** shift)
+        exponent += shift
+
+    return coefficient, exponent
+
+
+def to_cents(coefficient, exponent):
+    """ Quantizes the given number to cents (half to even). """
+
+    if exponent >= -2:
+        return coefficient * 10 ** (exponent + 2)
+
+    return divide_half_even(coefficient, 10 ** (-2 - exponent))
+
+
+class FixedPointSubsidyEngine(SubsidyEngine):
+    """ Calculates the same shares as the :class:`SubsidyEngine`, using
+    integers instead of decimals.
+
+    * Amounts are represented in cents (rappen).
+    * Percentages are represented in hundredths of a percent.
+    * The subsidy factor is represented in units of 1e-10.
+
+    The quantization steps are powers of ten, computed up front. The weeks
+    factor is the only value which is not exact (e.g. 49 / 12). Multiplying
+    with it is done as an exact division by 12, which only differs from the
+    decimal result if the exact result lies right between two cents. In this
+    case the weeks factor is used at the precision of the decimal context
+    and the product is rounded the way the decimal context does.
+
+    Values which cannot be represented this way (e.g. incomes with fractions
+    of cents) are calculated by the :class:`SubsidyEngine` instead.
+
+    """
+
+    def __init__(self, settings, daycare):
+        super().__init__(settings, daycare)
+
+        try:
+            self.rate = to_fixed(daycare.rate, 2)
+            self.min_rate = to_fixed(settings.min_rate, 2)
+            self.min_income = to_fixed(settings.min_income, 2)
+            self.max_wealth = to_fixed(settings.max_wealth, 2)
+            self.wealth_premium = to_fixed(settings.wealth_premium, 2)
+            self.rebate = to_fixed(settings.rebate, 2)
+            self.fixed_factor = to_fixed(self.factor, 10)
+            self.fixed_additional_rate = to_fixed(self.additional_rate, 2)
+        except ValueError:
+            self.exact = False
+        else:
+            self.exact = True
+
+        try:
+            self.weeks = to_fixed(Decimal(daycare.weeks), 0)
+        except ValueError:
+            self.exact = False
+
+        sign, digits, exponent = self.weeks_factor.as_tuple()
+        assert sign == 0
+
+        self.weeks_coefficient = int(''.join(str(d) for d in digits))
+        self.weeks_exponent = exponent
+        self.precision = getcontext().prec
+
+    def by_weeks_factor(self, amount, exponent):
+        """ Multiplies the given amount (amount * 10^exponent CHF) with the
+        weeks factor and returns the result in cents.
+
+        """
+        divisor = 12 * 10 ** (-2 - exponent)
+        quotient, remainder = divmod(amount * self.weeks, divisor)
+        remainder *= 2
+
+        if remainder == divisor:
+            return to_cents(*round_to_precision(
+                amount * self.weeks_coefficient,
+                self.weeks_exponent + exponent,
+                self.precision
+            ))
+
+        return quotient + (remainder > divisor)
+
+    def shares(self, income, wealth, services_total, rebate):
+        if not self.exact:
+            return super().shares(income, wealth, services_total, rebate)
+
+        try:
+            income = to_fixed(income, 2)
+            wealth = to_fixed(wealth, 2)
+            services_total = to_fixed(services_total, 2)
+        except ValueError:
+            return super().shares(income, wealth, services_total, rebate)
+
+        # income in cents + wealth premium in 1e-6 CHF
+        base = income * 10_000
+        base += max((wealth - self.max_wealth) * self.wealth_premium, 0)
+        base = max(divide_half_even(base, 10_000), 0)
+        base = max(base - self.min_income, 0)
+
+        # cents * factor in 1e-10
+        gross = max(divide_half_even(base * self.fixed_factor, 10 ** 10), 0)
+        gross = max(min(gross + self.min_rate, self.rate), 0)
+
+        # cents * rebate in hundredths of a percent
+        rebate = gross * self.rebate if rebate else 0
+
+        net = max(self.min_rate * 10_000, gross * 10_000 - rebate)
+        net = max(divide_half_even(net, 10_000), 0)
+
+        parent_per_day = max(net + self.fixed_additional_rate, 0)
+        city_per_day = max(self.rate - parent_per_day, 0)
+
+        # cents * services total in hundredths of a percent
+        parent_per_month = divide_half_even(
+            parent_per_day * services_total, 10_000)
+        parent_per_month = max(
+            self.by_weeks_factor(parent_per_month, -2), 0)
+
+        # cents * services total in hundredths of a percent -> 1e-6 CHF
+        city_per_month = self.by_weeks_factor(
+            city_per_day * services_total, -6)
+
+        return tuple(Decimal(v).scaleb(-2) for v in (
+            parent_per_day,
+            city_per_day,
+            parent_per_month,
+            city_per_month
+        ))
+
+
+class PiecewiseLinear(object):
+    """ A continuous, piecewise linear function, given by its breakpoints.
+
+    Before the first and after the last breakpoint, the function is constant.
+
+    """
+
+    def __init__(self, points):
+        self.points = tuple(sorted(points))
+        self.xs = tuple(x for x, y in self.points)
+
+    def __call__(self, x):
+        index = bisect_right(self.xs, x)
+
+        if index == 0:
+            return self.points[0][1]
+
+        if index == len(self.points):
+            return self.points[-1][1]
+
+        (x0, y0), (x1, y1) = self.points[index - 1], self.points[index]
+        return y0 + (y1 - y0) * (x - x0) / (x1 - x0)
+
+    def scaled(self, factor):
+        return self.__class__((x, y * factor) for x, y in self.points)
+
+    def solve(self, y):
+        """ Returns the smallest x at which the function reaches the given
+        value, or None if it never does.
+
+        """
+        x0, y0 = self.points[0]
+
+        if y0 == y:
+            return x0
+
+        for x1, y1 in self.points[1:]:
+            if min(y0, y1) <= y <= max(y0, y1):
+                return x0 + (x1 - x0) * (y - y0) / (y1 - y0)
+
+            x0, y0 = x1, y1
+
+        return None
+
+
+class SubsidyModel(object):
+    """ A closed form of the subsidy of a single daycare, without rounding.
+
+    All the operations of :meth:`DaycareSubsidyCalculator.calculate_precisely`
+    are piecewise linear in the determining income (the income plus the
+    wealth premium, minus the minimum income). The model compiles them into
+    a :class:`PiecewiseLinear` function with explicit breakpoints, which
+    can be evaluated instantly and solved for a given share.
+
+    The model differs from the calculation by a few cents, as the
+    calculation rounds each step. Use :meth:`exact_break_even_income` for
+    the exact result.
+
+    """
+
+    def __init__(self, settings, daycare, rebate=False):
+        self.settings = settings
+        self.daycare = daycare
+        self.rebate = rebate
+
+        self.factor = settings.factor(daycare)
+        self.additional_rate = max(daycare.rate - settings.max_rate, 0)
+
+    def parent_share(self, determining_income):
+        """ Returns the unrounded parent share per day. """
+
+        cfg = self.settings
+
+        gross = max(determining_income * self.factor, ZERO) + cfg.min_rate
+        gross = max(min(gross, self.daycare.rate), ZERO)
+
+        if self.rebate:
+            gross -= gross * cfg.rebate / HUNDRED
+
+        net = max(cfg.min_rate, gross, ZERO)
+
+        return max(net + self.additional_rate, ZERO)
+
+    def city_share(self, determining_income):
+        """ Returns the unrounded city share per day. """
+
+        return max(self.daycare.rate - self.parent_share(determining_income),
+                   ZERO)
+
+    @cached_property
+    def breakpoints(self):
+        """ The determining incomes at which the shares change their slope.
+
+        Beyond the last breakpoint, the parents pay the full rate.
+
+        """
+
+        cfg = self.settings
+        rate = self.daycare.rate
+
+        if self.factor <= 0:
+            return (ZERO, )
+
+        # rounded up to the next cent, so the shares are exact at the breaks
+        def income_at_gross(gross):
+            income = (gross - cfg.min_rate) / self.factor
+            return income.quantize(CENTS, rounding=ROUND_CEILING)
+
+        # the full rate is reached
+        cap = income_at_gross(rate)
+
+        # the city share reaches zero
+        candidates = [rate - self.additional_rate]
+
+        # the rebate no longer applies below the minimum rate
+        if self.rebate and cfg.rebate < HUNDRED:
+            discount = 1 - cfg.rebate / HUNDRED
+            candidates = [c / discount for c in candidates]
+            candidates.append(cfg.min_rate / discount)
+
+        candidates = (income_at_gross(c) for c in candidates)
+        candidates = (c for c in candidates if 0 < c < cap)
+
+        return tuple(sorted({ZERO, cap, *candidates}))
+
+    @cached_property
+    def parent_share_per_day(self):
+        return PiecewiseLinear(
+            (x, self.parent_share(x)) for x in self.breakpoints)
+
+    @cached_property
+    def city_share_per_day(self):
+        return PiecewiseLinear(
+            (x, self.city_share(x)) for x in self.breakpoints)
+
+    def wealth_premium(self, wealth):
+        cfg = self.settings
+        return max((wealth - cfg.max_wealth) * cfg.wealth_premium / HUNDRED, 0)
 
-        factor = min_day_rate / (self.max_income - self.min_income)
-        factor = factor.quantize(Decimal('0.000000001'))
+    def determining_income(self, income, wealth):
+        income = max(income + self.wealth_premium(wealth), ZERO)
+        return max(income - self.settings.min_income, ZERO)
 
-        return factor
+    def income(self, determining_income, wealth):
+        """ Returns the income which results in the given determining
+        income (the inverse of :meth:`determining_income`).
+
+        """
+        return max(
+            determining_income
+            + self.settings.min_income
+            - self.wealth_premium(wealth),
+            ZERO
+        )
+
+    def shares(self, income, wealth, services_total):
+        """ Returns the unrounded shares of a household, see
+        :meth:`SubsidyEngine.shares`.
+
+        """
+        x = self.determining_income(income, wealth)
+        month = services_total / HUNDRED * self.daycare.factor
+
+        parent = self.parent_share_per_day(x)
+        city = self.city_share_per_day(x)
+
+        return parent, city, parent * month, city * month
+
+    def income_for_city_share(self, city_share_per_day, wealth=ZERO):
+        """ Returns the lowest income at which the city share per day drops
+        to the given amount, or None if it never does.
+
+        """
+        x = self.city_share_per_day.solve(city_share_per_day)
+
+        if x is None:
+            return None
+
+        # all incomes below the minimum income are treated the same
+        if x == 0:
+            return ZERO
+
+        return self.income(x, wealth)
+
+    def break_even_income(self, wealth=ZERO):
+        """ Returns the lowest income at which the city no longer pays a
+        subsidy, or None if there is no such income.
+
+        """
+        return self.income_for_city_share(ZERO, wealth)
+
+    def exact_break_even_income(self, wealth=ZERO):
+        """ Returns the lowest income (in cents) at which the city share of
+        the calculation is zero, or None if there is no such income.
+
+        The model is exact up to the rounding of the calculation, so only
+        the few incomes around the modelled income are calculated.
+
+        """
+
+        income = self.break_even_income(wealth)
+
+        if income is None:
+            return None
+
+        engine = SubsidyEngine(self.settings, self.daycare)
+
+        def is_zero(cents):
+            income = Decimal(cents).scaleb(-2)
+            shares = engine.shares(income, wealth, HUNDRED, self.rebate)
+            return shares[1] == 0
+
+        # each rounding step is off by half a cent at most
+        if self.factor > 0:
+            window = int(Decimal('0.05') / self.factor * HUNDRED) + 1
+        else:
+            window = 1
+        cents = int(income * HUNDRED)
+
+        lower, upper = max(cents - window, 0), cents + window
+
+        while lower > 0 and is_zero(lower):
+            lower, upper = max(lower - window, 0), lower
+
+        while not is_zero(upper):
+            lower, upper = upper, upper + window
+
+        while lower < upper:
+            middle = (lower + upper) // 2
+
+            if is_zero(middle):
+                upper = middle
+            else:
+                lower = middle + 1
+
+        return Decimal(upper).scaleb(-2)
+
+
+def percentile(values, percent):
+    """ Returns the given percentile of the sorted values (nearest rank). """
+    rank = max(0, int(len(values) * percent / 100 + 0.5) - 1)
+    return values[min(rank, len(values) - 1)]
+
+
+class SettingsImpact(object):
+    """ Compares the monthly city share of two versions of the settings,
+    over a grid of incomes and wealths, for each daycare.
+
+    An engine is created once per daycare and version of the settings. The
+    factors of the daycares are shared through :func:`subsidy_factor`.
+
+    """
+
+    def __init__(self, old, new, daycares, services_total=Decimal('500'),
+                 rebate=False, income_steps=100, wealth_steps=4):
+
+        self.old = old
+        self.new = new
+        self.daycares = daycares
+        self.services_total = services_total
+        self.rebate = rebate
+        self.income_steps = income_steps
+        self.wealth_steps = wealth_steps
+
+    @cached_property
+    def incomes(self):
+        """ The incomes, up to 25% above the highest maximum income. """
+        limit = max(self.old.max_income, self.new.max_income) * Decimal('1.25')
+        step = (limit / self.income_steps).quantize(Decimal('1'))
+
+        return tuple(step * i for i in range(self.income_steps + 1))
+
+    @cached_property
+    def wealths(self):
+        """ The wealths, from nothing to far above the highest maximum
+        wealth (where the wealth premium applies).
+
+        """
+        limit = max(self.old.max_wealth, self.new.max_wealth) * 2
+        step = (limit / self.wealth_steps).quantize(Decimal('1'))
+
+        return tuple(step * i for i in range(self.wealth_steps + 1))
+
+    def city_shares(self, settings, daycare):
+        engine = SubsidyEngine(settings, daycare)
+        shares = engine.calculate(
+            incomes=tuple(i for i in self.incomes for w in self.wealths),
+            wealths=tuple(w for i in self.incomes for w in self.wealths),
+            services_totals=self.services_total,
+            rebates=self.rebate)
+
+        return shares.city_share_per_month
+
+    @cached_property
+    def deltas(self):
+        """ Returns the deltas of the city share per daycare (new - old). """
+
+        return OrderedDict(
+            (daycare, tuple(
+                new - old for old, new in zip(
+                    self.city_shares(self.old, daycare),
+                    self.city_shares(self.new, daycare)
+                )
+            )) for daycare in self.daycares
+        )
+
+    @staticmethod
+    def distribution(deltas):
+        deltas = sorted(deltas)
+
+        if not deltas:
+            return {'households': 0, 'changed': 0}
+
+        return {
+            'households': len(deltas),
+            'changed': sum(1 for d in deltas if d),
+            'min': deltas[0],
+            'max': deltas[-1],
+            'mean': (sum(deltas) / len(deltas)).quantize(CENTS),
+            'p10': percentile(deltas, 10),
+            'p50': percentile(deltas, 50),
+            'p90': percentile(deltas, 90),
+        }
+
+    def summary(self):
+        """ Returns the distribution of the deltas as a dictionary, in total
+        and for each daycare.
+
+        """
+        deltas = tuple(d for values in self.deltas.values() for d in values)
+
+        return {
+            'incomes': (self.incomes[0], self.incomes[-1]),
+            'wealths': (self.wealths[0], self.wealths[-1]),
+            'services_total': self.services_total,
+            'rebate': self.rebate,
+            'total': self.distribution(deltas),
+            'daycares': [
+                {
+                    'title': daycare.title,
+                    **self.distribution(values)
+                } for daycare, values in self.deltas.items()
+            ]
+        }
+
+
+SUBSIDY_ENGINES = {
+    'decimal': SubsidyEngine,
+    'fixed': FixedPointSubsidyEngine,
+}
+
+
+class CalculationCache(object):
+    """ A bounded LRU cache of calculations, with a time to live.
+
+    The cache is process-wide and shared between the requests of all
+    organisations, so each entry is stored in a scope (the directory of the
+    daycares). Each scope has a revision (see
+    :attr:`DaycareSubsidyCalculator.calculation_revision`). When it
+    changes, all entries of the scope are evicted.
+
+    The keys contain the income and wealth of a household, so they are only
+    stored as keyed hashes. As the calculations themselves contain them as
+    well, they are only kept for a few minutes, long enough for repeated
+    submissions.
+
+    """
+
+    def __init__(self, maxsize=1024, ttl=5 * 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.revisions = {}
+        self.lock = Lock()
+        self.secret = os.urandom(32)
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def digest(self, key):
+        return hmac.new(
+            self.secret, repr(key).encode('utf-8'), 'sha256').hexdigest()
+
+    def invalidate(self, scope=None):
+        """ Evicts all entries of the given scope, or all entries. """
+
+        with self.lock:
+            if scope is None:
+                self.evictions += len(self.entries)
+                self.entries.clear()
+                self.revisions.clear()
+            else:
+                self.evict(scope)
+
+    def evict(self, scope):
+        # the lock has to be held by the caller
+        keys = [k for k in self.entries if k[0] == scope]
+
+        for key in keys:
+            del self.entries[key]
+
+        self.evictions += len(keys)
+        self.revisions.pop(scope, None)
+
+    def get_or_create(self, scope, revision, key, creator):
+        key = (scope, self.digest(key))
+        now = monotonic()
+
+        with self.lock:
+            if self.revisions.get(scope, revision) != revision:
+                self.evict(scope)
+
+            self.revisions[scope] = revision
+            entry = self.entries.get(key)
+
+            if entry and now - entry[0] <= self.ttl:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+            self.misses += 1
+
+        value = creator()
+
+        with self.lock:
+
+            # the revision may have changed in the meantime
+            if self.revisions.get(scope) != revision:
+                return value
+
+            self.entries[key] = (now, value)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+        return value
+
+
+calculation_cache = CalculationCache()
 
 
 class DaycareSubsidyCalculator(object):
+    """ Calculates the subsidy paid by Winterthur for a daycare.
+
+    If a cache is given, the daycares read from the directory are shared
+    between requests. They are stored under the revision of the directory,
+    which changes whenever the directory or one of its entries is changed.
+
+    The calculations are then kept in the given calculations cache, which
+    defaults to the process-wide :data:`calculation_cache`.
+
+    The engine used for the summaries and batch calculations may be chosen
+    from the :data:`SUBSIDY_ENGINES` ('decimal' or 'fixed').
+
+    """
+
+    def __init__(self, session, cache=None, calculations=None,
+                 engine='decimal'):
+        assert engine in SUBSIDY_ENGINES
 
-    def __init__(self, session):
         self.session = session
+        self.cache = cache
+        self.engine = engine
+
+        if calculations is None:
+            calculations = calculation_cache
+
+        self.calculations = calculations
 
     @cached_property
     def organisation(self):
@@ -319,8 +1156,44 @@ class DaycareSubsidyCalculator(object):
     def directory(self):
         return DirectoryCollection(self.session).by_id(self.settings.directory)
 
+    @cached_property
+    def directory_revision(self):
+        """ Returns a marker which changes whenever the directory or any
+        of its entries are added, changed or removed.
+
+        """
+        count, changed = self.session.query(
+            func.count(DirectoryEntry.id),
+            func.max(func.coalesce(
+                DirectoryEntry.modified,
+                DirectoryEntry.created
+            ))
+        ).filter(DirectoryEntry.directory_id == self.directory.id).one()
+
+        directory_changed = self.directory.modified or self.directory.created
+
+        return '-'.join((
+            self.directory.id.hex,
+            str(count),
+            str(changed and changed.timestamp()),
+            str(directory_changed.timestamp())
+        ))
+
     @cached_property
     def daycares(self):
+        if self.cache is None:
+            return self.load_daycares()
+
+        key = f'daycares-{self.directory_revision}'
+        daycares = self.cache.get(key)
+
+        if not daycares:
+            daycares = self.load_daycares()
+            self.cache.set(key, daycares)
+
+        return daycares
+
+    def load_daycares(self):
         adapter = DirectoryDaycareAdapter(self.directory)
 
         items = DirectoryEntryCollection(self.directory).query()
@@ -329,11 +1202,130 @@ class DaycareSubsidyCalculator(object):
 
         return items
 
+    @cached_property
+    def daycares_by_title(self):
+        """ The daycares by title. If multiple daycares share a title, the
+        first one is used (see :attr:`ambiguous_titles`).
+
+        """
+        daycares = {}
+
+        for daycare in self.daycares.values():
+            daycares.setdefault(daycare.title, daycare)
+
+        return daycares
+
+    @cached_property
+    def ambiguous_titles(self):
+        """ The titles shared by multiple daycares. """
+
+        titles = Counter(d.title for d in self.daycares.values())
+        return sorted(title for title, count in titles.items() if count > 1)
+
     def daycare_by_title(self, title):
-        return next(d for d in self.daycares.values() if d.title == title)
+        return self.daycares_by_title[title]
+
+    @cached_property
+    def calculation_revision(self):
+        return f'{self.settings.version}-{self.directory_revision}'
+
+    def calculation_key(self, daycare, services, income, wealth, rebate,
+                        summary_only):
+        """ Returns the canonical key of a calculation. """
+
+        return (
+            daycare.id,
+            daycare.rate,
+            daycare.weeks,
+            tuple(sorted(
+                (service_id, tuple(sorted(days)))
+                for service_id, days in services.selected.items() if days
+            )),
+            income,
+            wealth,
+            bool(rebate),
+            summary_only
+        )
+
+    def calculate(self, daycare, services, income, wealth, rebate,
+                  summary_only=False):
+        """ Calculates the subsidy (see :meth:`calculate_precisely` and
+        :meth:`calculate_summary`).
+
+        With a cache, the results are kept in the calculations cache,
+        so repeated calculations are not computed again.
+
+        """
+        arguments = (daycare, services, income, wealth, rebate)
+
+        def calculate():
+            if summary_only:
+                return self.calculate_summary(*arguments)
+
+            return self.calculate_precisely(*arguments)
+
+        if self.cache is None:
+            return calculate()
+
+        return self.calculations.get_or_create(
+            scope=self.settings.directory,
+            revision=self.calculation_revision,
+            key=self.calculation_key(*arguments, summary_only),
+            creator=calculate)
+
+    def calculate_summary(self, daycare, services, income, wealth, rebate):
+        """ Calculates the monthly totals of :meth:`calculate_precisely`,
+        without creating the blocks, notes and the agenda.
+
+        The totals are returned as decimals, rounded to 5 cents.
+
+        """
+        engine = self.subsidy_engine(daycare)
+
+        parent_share_per_month, city_share_per_month = engine.shares(
+            income, wealth, services.total, rebate)[2:]
+
+        parent_share_per_month = round_to(parent_share_per_month, '0.05')
+        city_share_per_month = round_to(city_share_per_month, '0.05')
+
+        return Bunch(
+            parent_share_per_month=parent_share_per_month,
+            city_share_per_month=city_share_per_month,
+            total_per_month=parent_share_per_month + city_share_per_month,
+        )
+
+    def compare(self, services, income, wealth, rebate):
+        """ Calculates the monthly totals of a single household for each
+        daycare (see :meth:`calculate_summary`).
+
+        Returns a tuple of results with the daycare and the totals.
+
+        """
+
+        def result(daycare):
+            summary = self.calculate_summary(
+                daycare, services, income, wealth, rebate)
+            summary.daycare = daycare
+
+            return summary
+
+        return tuple(result(d) for d in self.daycares.values())
+
+    def subsidy_engine(self, daycare):
+        return SUBSIDY_ENGINES[self.engine](self.settings, daycare)
 
-    def calculate(self, *args, **kwargs):
-        return self.calculate_precisely(*args, **kwargs)
+    def subsidy_model(self, daycare, rebate=False):
+        return SubsidyModel(self.settings, daycare, rebate)
+
+    def calculate_many(self, daycare, incomes, wealths, services_totals,
+                       rebates):
+        """ Calculates the shares of many households for the given daycare.
+
+        See :meth:`SubsidyEngine.calculate`.
+
+        """
+        return self.subsidy_engine(daycare).calculate(
+            incomes, wealths, services_totals, rebates)
 
     def calculate_precisely(self, daycare, services, income, wealth, rebate):
         """ Creates a detailed calculation of the subsidy paid by Winterthur.
@@ -714,6 +1706,11 @@ class DaycareSubsidyCalculatorForm(Form):
 
     @property
     def selected_daycare(self):
-        for daycare in self.model.daycares.values():
-            if daycare.id.hex == self.daycare.data:
-                return daycare
+        return self.model.daycares.get(self.daycare.data)
+
+
+class DaycareSubsidyComparisonForm(DaycareSubsidyCalculatorForm):
+    """ Asks for the household only, to compare all daycares. """
+
+    def on_request(self):
+        self.delete_field('daycare')
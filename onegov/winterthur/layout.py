@@ -85,6 +85,23 @@ class DaycareSubsidyCalculatorLayout(DefaultLayout):
         )
 
 
+class DaycareSubsidyComparisonLayout(DefaultLayout):
+
+    @cached_property
+    def breadcrumbs(self):
+        return (
+            Link(_("Homepage"), self.homepage_url),
+            Link(
+                _("Daycare Subsidy Calculator"),
+                self.request.link(self.model)
+            ),
+            Link(
+                _("Daycare Comparison"),
+                self.request.link(self.model, name='compare')
+            )
+        )
+
+
 class MissionReportLayout(DefaultLayout):
 
     def __init__(self, model, request, *suffixes):
@@ -16,7 +16,7 @@ from uuid import UUID
     model=AddressCollection,
     path='/streets')
 def get_streets_directory(app):
-    return AddressCollection(app.session())
+    return AddressCollection(app.session(), cache=app.streets_cache)
 
 
 @WinterthurApp.path(
@@ -92,4 +92,5 @@ def get_mission_report_vehicle(request, id):
     model=DaycareSubsidyCalculator,
     path='/daycare-subsidy-calculator')
 def get_daycare_subsidy_calculator(request):
-    return DaycareSubsidyCalculator(request.session)
+    return DaycareSubsidyCalculator(
+        request.session, cache=request.app.daycare_cache)
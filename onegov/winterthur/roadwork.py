@@ -1,13 +1,21 @@
 import isodate
 import pycurl
 import sedate
+import zlib
 
-from cached_property import cached_property
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from io import BytesIO
 from onegov.core.custom import json
+from onegov.winterthur import log
+from ordered_set import OrderedSet
 from pathlib import Path
 from purl import URL
+from queue import Empty, LifoQueue
+from threading import Lock, Thread
+from time import monotonic, sleep
 
 
 class RoadworkError(Exception):
@@ -18,6 +26,52 @@ class RoadworkConnectionError(RoadworkError):
     pass
 
 
+class Lease(object):
+    """ A lock shared through redis, which expires after the given number of
+    seconds. This way, a process which dies while holding the lock does not
+    keep the other processes from acquiring it for good.
+
+    """
+
+    def __init__(self, client, key, timeout):
+        self.lock = client.lock(key, timeout=timeout)
+
+    def acquire(self, blocking=True):
+        return self.lock.acquire(blocking=blocking)
+
+    def release(self):
+        # once expired, the lease may already be held by another process
+        if self.lock.owned():
+            self.lock.release()
+
+
+def shared_lock(cache, key, lease):
+    """ Returns a lock shared by all processes using the given cache, or None
+    if the cache backend does not support it.
+
+    With redis, the lock is a :class:`Lease`, held for at most `lease`
+    seconds. Other backends may return locks without an expiry.
+
+    """
+
+    backend = getattr(cache, 'backend', None)
+
+    if backend is None:
+        return None
+
+    key_mangler = getattr(cache, 'key_mangler', None)
+    key = key_mangler and key_mangler(key) or key
+
+    # dogpile's redis mutex does not expire by default
+    client = getattr(backend, 'writer_client', None) \
+        or getattr(backend, 'client', None)
+
+    if client is not None and hasattr(client, 'lock'):
+        return Lease(client, key, lease)
+
+    return backend.get_mutex(key)
+
+
 class RoadworkConfig(object):
     """ Looks at ~/.pdb.secret and /etc/pdb.secret (in this order), to extract
     the configuration used for the RoadworkClient class.
@@ -28,19 +82,26 @@ class RoadworkConfig(object):
         ENDPOINT: 127.0.0.1:6004
         USERNAME: username
         PASSWORD: password
+        CONNECT_TIMEOUT: 5
+        TIMEOUT: 30
 
     * The HOSTNAME is the address of the PDB service.
     * The ENDPOINT is the optional address of the tcp-proxy used.
     * The USERNAME is the NTLM password.
     * The PASSWORD is the NTLM password.
+    * The CONNECT_TIMEOUT is the optional connect timeout in seconds.
+    * The TIMEOUT is the optional timeout of a whole request in seconds.
 
     """
 
-    def __init__(self, hostname, endpoint, username, password):
+    def __init__(self, hostname, endpoint, username, password,
+                 connect_timeout=None, timeout=None):
         self.hostname = hostname
         self.endpoint = endpoint
         self.username = username
         self.password = password
+        self.connect_timeout = float(connect_timeout or 5)
+        self.timeout = float(timeout or 30)
 
     @classmethod
     def lookup_paths(self):
@@ -64,6 +125,8 @@ class RoadworkConfig(object):
             'endpoint': None,
             'username': None,
             'password': None,
+            'connect_timeout': None,
+            'timeout': None,
         }
 
         with path.open('r') as file:
@@ -89,6 +152,131 @@ class RoadworkConfig(object):
         return result
 
 
+class RoadworkCircuitBreaker(object):
+    """ Keeps track of the failed requests to the PDB service, to stop
+    sending requests once it is clearly unavailable.
+
+    The circuit breaker has three states:
+
+    * Closed: Requests are sent. After `threshold` consecutive failures,
+      the circuit opens.
+    * Open: No requests are sent during the cool-down.
+    * Half-open: After the cool-down, a single probe is sent. If it succeeds
+      the circuit closes, if it fails, the circuit opens again.
+
+    The state is stored in the cache, so it is shared between all processes
+    using the same cache backend. Changes of the state are made under a lock
+    shared by these processes (see :meth:`transition`).
+
+    """
+
+    key = 'circuit-breaker'
+
+    #: the longest time a process may hold the lock of the state (in seconds)
+    lease = 5
+
+    #: the lock of the state, if the cache does not provide a shared one
+    local_lock = Lock()
+
+    def __init__(self, cache, threshold=3, cooldown=30):
+        self.cache = cache
+        self.threshold = threshold
+        self.cooldown = timedelta(seconds=cooldown)
+
+    @contextmanager
+    def transition(self):
+        """ Serialises the changes of the state, between all processes using
+        the same cache backend, if possible.
+
+        """
+
+        lock = shared_lock(self.cache, f'{self.key}-lock', lease=self.lease)
+        lock = lock or self.local_lock
+        lock.acquire()
+
+        try:
+            yield
+        finally:
+            lock.release()
+
+    def load(self):
+        return self.cache.get(self.key) or {
+            'failures': 0,
+            'opened': None,
+            'probed': None
+        }
+
+    def store(self, state):
+        self.cache.set(self.key, state)
+
+    @property
+    def state(self):
+        state = self.load()
+
+        if not state['opened']:
+            return 'closed'
+
+        if datetime.utcnow() < state['opened'] + self.cooldown:
+            return 'open'
+
+        return 'half-open'
+
+    @property
+    def is_open(self):
+        """ True if no request may be sent, without claiming the probe. """
+
+        state = self.load()
+
+        if not state['opened']:
+            return False
+
+        now = datetime.utcnow()
+
+        if now < state['opened'] + self.cooldown:
+            return True
+
+        return bool(state['probed'] and now < state['probed'] + self.cooldown)
+
+    def allow(self):
+        """ Returns True if a request may be sent. In the half-open state,
+        only the first caller is allowed to send the probe.
+
+        """
+
+        if not self.load()['opened']:
+            return True
+
+        with self.transition():
+            if self.is_open:
+                return False
+
+            state = self.load()
+
+            if state['opened']:
+                state['probed'] = datetime.utcnow()
+                self.store(state)
+
+            return True
+
+    def success(self):
+        if not any(self.load().values()):
+            return
+
+        with self.transition():
+            self.store({'failures': 0, 'opened': None, 'probed': None})
+
+    def failure(self):
+        with self.transition():
+            state = self.load()
+            state['failures'] += 1
+
+            if state['opened'] or state['failures'] >= self.threshold:
+                state['opened'] = datetime.utcnow()
+                state['probed'] = None
+
+            self.store(state)
+
+
 class RoadworkClient(object):
     """ A proxy to Winterthur's internal roadworks service. Uses redis as
     a caching mechanism to ensure performance and reliability.
@@ -101,33 +289,137 @@ class RoadworkClient(object):
 
     """
 
-    def __init__(self, cache, hostname, username, password, endpoint=None):
+    #: how long to wait for the refresh of another process (in seconds)
+    refresh_timeout = 1.5
+
+    #: how often to check if the refresh of another process is done
+    refresh_interval = 0.1
+
+    #: the fields of the roadwork records which are stored in the cache
+    fields = (
+        'DauerBis',
+        'DauerVon',
+        'Id',
+        'Internet',
+        'Massnahmen',
+        'ProjektBereich',
+        'ProjektBezeichnung',
+        'SachbearbeiterBau',
+        'SachbearbeiterBauZusatz',
+        'SachbearbeiterVerkehr',
+        'SachbearbeiterVerkehrZusatz',
+        'Teilbaustellen',
+        'TeilbaustelleId',
+        'UrlStadtplan',
+    )
+
+    #: the zlib compression level of the stored records
+    compression = 6
+
+    def __init__(self, cache, hostname, username, password, endpoint=None,
+                 connect_timeout=5, timeout=30, pool_size=4):
         self.cache = cache
         self.hostname = hostname
         self.username = username
         self.password = password
         self.endpoint = endpoint or hostname
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+
+        # a bounded pool of curl handles, each keeping its NTLM authenticated
+        # connection alive - the last used handle is the first reused
+        self.pool = LifoQueue(maxsize=pool_size)
+        self.pool_size = pool_size
+        self.pool_lock = Lock()
+
+        # the number of places in the pool taken so far
+        self.handles = 0
+
+        # the paths currently refreshed in the background
+        self.refreshing = set()
+        self.refresh_lock = Lock()
+
+        # the process-local refresh locks, if the cache has none
+        self.refresh_mutexes = {}
+
+        # the number of requests coalesced with another refresh
+        self.coalesced = 0
+
+        # the data derived from cache entries, by name
+        self.memos = {}
 
-    @cached_property
-    def curl(self):
+        self.breaker = RoadworkCircuitBreaker(cache)
+
+    def create_handle(self):
         curl = pycurl.Curl()
         curl.setopt(pycurl.HTTPAUTH, pycurl.HTTPAUTH_NTLM)
         curl.setopt(pycurl.USERPWD, f"{self.username}:{self.password}")
         curl.setopt(pycurl.HTTPHEADER, [f'HOST: {self.hostname}'])
 
+        # signals cannot be used for timeouts outside the main thread
+        curl.setopt(pycurl.NOSIGNAL, 1)
+        curl.setopt(
+            pycurl.CONNECTTIMEOUT_MS, int(self.connect_timeout * 1000))
+        curl.setopt(pycurl.TIMEOUT_MS, int(self.timeout * 1000))
+
         return curl
 
+    @contextmanager
+    def handle(self):
+        """ Borrows a curl handle from the pool. If all handles are in use
+        and the pool is full, waits for a handle to be returned.
+
+        Handles which fail are closed and their place in the pool is taken
+        by None, so the next caller (possibly one which is waiting) creates
+        a new handle in their stead.
+
+        """
+
+        try:
+            curl = self.pool.get_nowait()
+        except Empty:
+            with self.pool_lock:
+                create = self.handles < self.pool_size
+
+                if create:
+                    self.handles += 1
+
+            curl = None if create else self.pool.get()
+
+        try:
+            if curl is None:
+                curl = self.create_handle()
+
+            yield curl
+        except Exception:
+            if curl is not None:
+                curl.close()
+
+            self.pool.put(None)
+            raise
+        else:
+            self.pool.put(curl)
+
     def url(self, path):
         return f'http://{self.endpoint}/{path}'
 
     def get(self, path, lifetime=5 * 60, downtime=60 * 60):
         """ Requests the given path, returning the resulting json if
-        successful.
+        successful (see :meth:`get_entry`).
+
+        """
+        return self.decode(self.get_entry(path, lifetime, downtime))
+
+    def get_entry(self, path, lifetime=5 * 60, downtime=60 * 60):
+        """ Requests the given path, returning the cache entry containing
+        the resulting json (see :meth:`decode`) and the time it was fetched
+        ('created').
 
         A cache is used in two stages:
 
         * At the lifetime stage, the cache is returned unconditionally.
-        * At the end of the lifetime, the cache is refreshed if possible.
+        * At the end of the lifetime, the cache is returned as well, but it
+          is refreshed in the background.
         * At the end of the downtime stage the cache forcefully refreshed.
 
         During its lifetime the object is basically up to 5 minutes out of
@@ -139,32 +431,18 @@ class RoadworkClient(object):
         do however evict the cache forcefully, raising an error if we cannot
         connect to the backend.
 
+        As the refresh between lifetime and downtime happens in a background
+        thread, requests do not wait for the backend until the downtime
+        is up, whether the backend is slow, unavailable or not.
+
         """
         path = path.lstrip('/')
 
         cached = self.cache.get(path)
 
-        def refresh():
-            try:
-                status, body = self.get_uncached(path)
-            except pycurl.error:
-                raise RoadworkConnectionError(
-                    f"Could not connect to {self.hostname}")
-
-            if status == 200:
-                self.cache.set(path, {
-                    'created': datetime.utcnow(),
-                    'status': status,
-                    'body': body
-                })
-
-                return body
-
-            raise RoadworkError(f"{path} returned {status}")
-
         # no cache yet, return result and cache it
         if not cached:
-            return refresh()
+            return self.refresh(path, cached)
 
         now = datetime.utcnow()
         lifetime_horizon = cached['created'] + timedelta(seconds=lifetime)
@@ -172,27 +450,247 @@ class RoadworkClient(object):
 
         # within cache lifetime, return cached value
         if now <= lifetime_horizon:
-            return cached['body']
+            return cached
 
-        # outside cache lifetime, but still in downtime horizon, try to
-        # refresh the value but ignore errors
+        # outside cache lifetime, but still in downtime horizon, return the
+        # cached value and refresh it in the background
         if lifetime_horizon < now < downtime_horizon:
-            try:
-                return refresh()
-            except RoadworkConnectionError:
-                return cached['body']
+            self.refresh_in_background(path, cached)
+            return cached
 
         # outside the downtime lifetime, force refresh and raise errors
-        return refresh()
+        return self.refresh(path, cached)
+
+    def refresh(self, path, cached=None, wait=True):
+        """ Requests the given path and stores the resulting entry in the
+        cache.
+
+        Only one process refreshes a given path at a time. If another process
+        is already refreshing it, the request is coalesced with that refresh:
+
+        * With wait=True and a cached value, the result of the other process
+          is awaited for up to `refresh_timeout` seconds, after which the
+          cached value is returned.
+        * With wait=True and no cached value, the other process is awaited
+          until it is done (or its lease expires). If it failed, the path is
+          requested once the lock is acquired.
+        * With wait=False, nothing is done and None is returned.
+
+        This way, the backend is never asked by more than one process at
+        a time for the same path.
+
+        The cached value known to the caller is passed, so a refresh which
+        has finished in the meantime is recognised.
+
+        """
+
+        lock = self.refresh_mutex(path)
+
+        if not lock.acquire(False):
+            with self.refresh_lock:
+                self.coalesced += 1
+
+            if not wait:
+                return None
+
+            if cached:
+                return self.wait_for_refresh(path, cached) or cached
+
+            lock.acquire()
+
+        try:
+            refreshed = self.cache.get(path)
+
+            if refreshed and self.is_newer(refreshed, cached):
+                return refreshed
+
+            return self.fetch(path)
+        finally:
+            lock.release()
+
+    def refresh_mutex(self, path):
+        """ Returns the lock guarding the refresh of the given path.
+
+        If the cache backend supports it (e.g. redis with distributed locks),
+        the lock is shared between all processes. Otherwise it is local to
+        this process.
+
+        A shared lock is held for at most twice the request timeout, so it
+        is released even if the process holding it dies.
+
+        """
+
+        key = f'refresh-{path}'
+        mutex = shared_lock(self.cache, key, lease=2 * self.timeout)
+
+        if mutex is not None:
+            return mutex
+
+        with self.refresh_lock:
+            if key not in self.refresh_mutexes:
+                self.refresh_mutexes[key] = Lock()
+
+            return self.refresh_mutexes[key]
+
+    @staticmethod
+    def is_newer(entry, cached):
+        return not cached or entry['created'] > cached['created']
+
+    def wait_for_refresh(self, path, cached):
+        """ Waits for the refresh of another process and returns the
+        refreshed entry, or None if it did not finish in time.
+
+        """
+        timeout = monotonic() + self.refresh_timeout
+
+        while monotonic() < timeout:
+            sleep(self.refresh_interval)
+
+            refreshed = self.cache.get(path)
+
+            if refreshed and self.is_newer(refreshed, cached):
+                return refreshed
+
+        return None
+
+    def fetch(self, path):
+        """ Requests the given path and stores the result in the cache,
+        without any coordination.
+
+        """
+
+        if not self.breaker.allow():
+            raise RoadworkConnectionError(
+                f"Not connecting to {self.hostname} after repeated failures")
+
+        try:
+            status, body = self.get_uncached(path)
+        except pycurl.error:
+            self.breaker.failure()
+            raise RoadworkConnectionError(
+                f"Could not connect to {self.hostname}")
+
+        # server errors are usually caused by the proxy in front of the
+        # service, so they are treated like connection errors
+        if status >= 500:
+            self.breaker.failure()
+            raise RoadworkConnectionError(f"{path} returned {status}")
+
+        self.breaker.success()
+
+        if status == 200:
+            entry = {
+                'created': datetime.utcnow(),
+                'status': status,
+                **self.encode(body)
+            }
+
+            self.cache.set(path, entry)
+
+            return entry
+
+        raise RoadworkError(f"{path} returned {status}")
+
+    def prune(self, body):
+        """ Removes the fields of the records in the body, which are not
+        used by :class:`Roadwork` or the templates.
+
+        """
+
+        def prune_record(record):
+            record = {k: record[k] for k in self.fields if k in record}
+
+            if record.get('Teilbaustellen'):
+                record['Teilbaustellen'] = [
+                    prune_record(r) for r in record['Teilbaustellen']
+                ]
+
+            return record
+
+        if isinstance(body, dict) and isinstance(body.get('value'), list):
+            return {**body, 'value': [prune_record(r) for r in body['value']]}
+
+        return body
+
+    def encode(self, body):
+        """ Returns the pruned body as compressed json, to be stored in the
+        cache entry.
+
+        """
+
+        data = json.dumps(self.prune(body)).encode('utf-8')
+        return {'data': zlib.compress(data, self.compression)}
+
+    def decode(self, entry):
+        """ Returns the body stored in the given cache entry. """
+
+        # entries written before the body was compressed
+        if 'body' in entry:
+            return entry['body']
+
+        return json.loads(zlib.decompress(entry['data']).decode('utf-8'))
+
+    def memoize(self, name, path, entry, factory):
+        """ Returns the data derived from the given cache entry by the given
+        factory. The data is created once per entry and process, so it is
+        only created again after the entry has been refreshed.
+
+        """
+
+        memo = self.memos.get(name)
+
+        if memo and memo[0] == path and memo[1] == entry['created']:
+            return memo[2]
+
+        data = factory(self.decode(entry))
+        self.memos[name] = (path, entry['created'], data)
+
+        return data
+
+    def refresh_in_background(self, path, cached=None):
+        """ Refreshes the given path in a background thread, unless a
+        refresh of the same path is already underway.
+
+        Errors are ignored, as the cached value may still be used until the
+        downtime is up.
+
+        """
+
+        # there is no point in trying while the backend is known to be down
+        if self.breaker.is_open:
+            return
+
+        with self.refresh_lock:
+            if path in self.refreshing:
+                self.coalesced += 1
+                return
+
+            self.refreshing.add(path)
+
+        def refresh():
+            try:
+                self.refresh(path, cached, wait=False)
+            except RoadworkError as e:
+                log.warning(f"Failed to refresh {path}: {e}")
+            finally:
+                with self.refresh_lock:
+                    self.refreshing.discard(path)
+
+        thread = Thread(target=refresh, name='roadwork-refresh', daemon=True)
+        thread.start()
+
+        return thread
 
     def get_uncached(self, path):
         body = BytesIO()
 
-        self.curl.setopt(pycurl.URL, self.url(path))
-        self.curl.setopt(pycurl.WRITEFUNCTION, body.write)
-        self.curl.perform()
+        with self.handle() as curl:
+            curl.setopt(pycurl.URL, self.url(path))
+            curl.setopt(pycurl.WRITEFUNCTION, body.write)
+            curl.perform()
+
+            status = curl.getinfo(pycurl.RESPONSE_CODE)
 
-        status = self.curl.getinfo(pycurl.RESPONSE_CODE)
         body = body.getvalue().decode('utf-8')
 
         if status == 200:
@@ -204,6 +702,39 @@ class RoadworkClient(object):
         return response[0] == 200
 
 
+class RoadworkSnapshot(object):
+    """ The active roadwork at the time of a refresh, sorted by title and
+    indexed by letter and by section id.
+
+    All views of the roadwork collection are derived from the same
+    snapshot, which is created once per process and refresh.
+
+    """
+
+    def __init__(self, roadwork):
+        self.roadwork = tuple(roadwork)
+
+        by_letter = defaultdict(list)
+
+        for r in self.roadwork:
+            for letter in OrderedSet(r.letters):
+                by_letter[letter].append(r)
+
+        self.by_letter = {k: tuple(v) for k, v in by_letter.items()}
+        self.letters = sorted(self.by_letter)
+
+        self.sections = {
+            section.id: section
+            for r in self.roadwork
+            for section in r.all_sections
+        }
+
+        self.titles = tuple(r.title.lower() for r in self.roadwork)
+
+    def search(self, query):
+        return [r for r, t in zip(self.roadwork, self.titles) if query in t]
+
+
 class RoadworkCollection(object):
 
     def __init__(self, client, letter=None, query=None):
@@ -219,25 +750,23 @@ class RoadworkCollection(object):
 
     @property
     def letters(self):
-        letters = set()
-
-        for roadwork in self.by_letter(None).roadwork:
-            for letter in roadwork.letters:
-                letters.add(letter)
-
-        letters = list(letters)
-        letters.sort()
-
-        return letters
+        return self.snapshot.letters
 
-    def by_filter(self, filter):
+    def path(self, filter):
 
         # note: addGisLink doesn't work here
         url = URL('odata/Baustellen')\
             .query_param('addGisLink', 'False')\
             .query_param('$filter', filter)
 
-        records = self.client.get(url.as_string()).get('value', ())
+        return url.as_string()
+
+    def by_filter(self, filter):
+        return self.roadwork_by_body(self.client.get(self.path(filter)))
+
+    @staticmethod
+    def roadwork_by_body(body):
+        records = body.get('value', ())
         records = (r for r in records if r['Internet'])
 
         work = [Roadwork(r) for r in records]
@@ -246,107 +775,211 @@ class RoadworkCollection(object):
         return work
 
     @property
-    def roadwork(self):
+    def active_filter(self):
         date = datetime.today()
 
-        roadwork = self.by_filter(filter=' and '.join((
+        return ' and '.join((
             f'DauerVon le {date.strftime("%Y-%m-%d")}',
             f'DauerBis ge {date.strftime("%Y-%m-%d")}',
-        )))
+        ))
+
+    @property
+    def snapshot(self):
+        """ The snapshot of the active roadwork, see
+        :class:`RoadworkSnapshot`.
+
+        """
+
+        path = self.path(self.active_filter)
+        entry = self.client.get_entry(path)
+
+        return self.client.memoize(
+            'snapshot', path, entry,
+            lambda body: RoadworkSnapshot(self.roadwork_by_body(body)))
+
+    @property
+    def roadwork(self):
+        snapshot = self.snapshot
 
         # The backend supports searches/filters, but the used dataset is
         # so small that it makes little sense to use that feature, since it
         # would lead to a lot more cache-misses on our end.
         #
-        # Instead we simply loop through the results and filter them out.
+        # Instead we simply filter the snapshot.
         if self.query:
-            roadwork = [
-                r for r in roadwork if self.query in r.title.lower()
-            ]
+            return snapshot.search(self.query)
 
-        elif self.letter:
-            roadwork = [
-                r for r in roadwork if self.letter in r.letters
-            ]
+        if self.letter:
+            return list(snapshot.by_letter.get(self.letter, ()))
 
-        return roadwork
+        return list(snapshot.roadwork)
 
-    def by_id(self, id):
+    def detail_path(self, id):
         url = URL(f'odata/Baustellen({int(id)})')\
             .query_param('addGisLink', 'True')
 
+        return url.as_string()
+
+    def by_id(self, id):
         work = tuple(
             Roadwork(r) for r in self.client.get(
-                url.as_string()).get('value', ()))
+                self.detail_path(id)).get('value', ()))
 
         if work:
             return work[0]
 
-        # secondary lookup is against the subsections.. this probably calls
-        # for an index eventually
-        for r in self.roadwork:
-            for section in r.sections:
-                if section.id == id:
-                    return section
+        # secondary lookup is against the subsections
+        section = self.sections.get(id)
+
+        if section and section.is_active(sedate.utcnow()):
+            return section
+
+    @property
+    def sections(self):
+        """ The sections of the active roadwork by id. """
+
+        return self.snapshot.sections
 
     def by_letter(self, letter):
         return self.__class__(self.client, letter=letter, query=None)
 
+    def warm(self, max_workers=4):
+        """ Refreshes the active roadwork and the details of each project and
+        section in the cache, so visitors do not have to wait for the backend.
+
+        The sections are included, as :meth:`by_id` asks the backend for
+        the details of a section, before looking it up in the snapshot.
+
+        The details are fetched concurrently, by a bounded number of
+        threads. Returns the number of refreshed details.
+
+        """
+
+        def refresh(path):
+            try:
+                self.client.refresh(path, self.client.cache.get(path))
+            except RoadworkError as e:
+                log.warning(f"Failed to warm {path}: {e}")
+                return False
+
+            return True
+
+        path = self.path(self.active_filter)
+
+        if not refresh(path) and not self.client.cache.get(path):
+            return 0
+
+        snapshot = self.snapshot
+        ids = (*(r.id for r in snapshot.roadwork), *snapshot.sections)
+        paths = (self.detail_path(id) for id in ids)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return sum(executor.map(refresh, paths))
+
+
+def parse_datetime(value):
+    return value and isodate.parse_datetime(value)
+
 
 class Roadwork(object):
+    """ A single roadwork project or one of its sections.
+
+    The record is created for every roadwork shown, so the fields used
+    in the views are converted once, on construction, and the record itself
+    is kept small.
+
+    """
+
+    __slots__ = (
+        'data',
+        'id',
+        'start',
+        'end',
+        'title',
+        'letters',
+        '_all_sections',
+        '_sections',
+        '_sections_until',
+    )
+
+    #: the keys of the data which are converted
+    converted = {
+        'DauerVon': 'start',
+        'DauerBis': 'end',
+    }
 
     def __init__(self, data):
         self.data = data
+        self.id = data['Id']
+        self.start = parse_datetime(data.get('DauerVon'))
+        self.end = parse_datetime(data.get('DauerBis'))
 
-        self.convertors = {
-            'DauerVon': lambda v: v and isodate.parse_datetime(v),
-            'DauerBis': lambda v: v and isodate.parse_datetime(v),
-        }
+        parts = (data.get(k) for k in ('ProjektBezeichnung', 'ProjektBereich'))
+        parts = (p.strip() for p in parts if p)
+        parts = tuple(p for p in parts if p)
+
+        self.title = ' '.join(parts)
+        self.letters = tuple(
+            p[0].lower() for p in parts
+            if p[0].lower() in 'abcdefghijklmnopqrstuvwxyz'
+        )
+
+        self._all_sections = None
+        self._sections = None
+        self._sections_until = None
 
     @property
-    def id(self):
-        return self['Id']
+    def all_sections(self):
+        if self._all_sections is None:
+            self._all_sections = tuple(
+                self.__class__({
+                    'Id': r['TeilbaustelleId'],
+                    'Teilbaustellen': [],
+                    **r
+                }) for r in self.data.get('Teilbaustellen') or ()
+            )
+
+        return self._all_sections
 
     @property
-    def letters(self):
-        for key in ('ProjektBezeichnung', 'ProjektBereich'):
-            if self[key]:
-                letter = self[key][0].lower()
+    def sections(self):
+        """ The active sections. They are cached until the next section
+        starts or ends.
 
-                if letter in ('abcdefghijklmnopqrstuvwxyz'):
-                    yield letter
+        """
+        now = sedate.utcnow()
 
-    @property
-    def title(self):
-        parts = (self[key] for key in ('ProjektBezeichnung', 'ProjektBereich'))
-        parts = (p.strip() for p in parts if p)
-        parts = (p for p in parts)
+        if self._sections is None or self._sections_until <= now:
+            self._sections = [s for s in self.all_sections if s.is_active(now)]
+            self._sections_until = min((
+                t for s in self.all_sections for t in s.changes if t > now
+            ), default=datetime.max.replace(tzinfo=now.tzinfo))
 
-        return ' '.join(parts)
+        return self._sections
 
     @property
-    def sections(self):
-        now = sedate.utcnow()
+    def changes(self):
+        """ The points in time at which the record becomes active or
+        inactive.
 
-        sections = (
-            self.__class__({
-                'Id': r['TeilbaustelleId'],
-                'Teilbaustellen': [],
-                **r
-            }) for r in self['Teilbaustellen']
-        )
+        """
+        if self.start:
+            yield self.start
+
+        if self.end:
+            yield self.end + timedelta(microseconds=1)
 
-        sections = (s for s in sections if s['DauerVon'])
-        sections = (s for s in sections if s['DauerVon'] <= now)
-        sections = (s for s in sections if now <= (s['DauerBis'] or now))
+    def is_active(self, now):
+        if not self.start:
+            return False
 
-        return list(sections)
+        return self.start <= now <= (self.end or now)
 
     def __getitem__(self, key):
         value = self.data[key]
 
-        if key in self.convertors:
-            return self.convertors[key](value)
+        if key in self.converted:
+            return getattr(self, self.converted[key])
 
         return value
 
@@ -0,0 +1,46 @@
+""" Helpers for benchmarks, which are not run by default, as their results
+depend on the machine. To run them and see their results::
+
+    BENCHMARK=1 py.test -s -k benchmark
+
+"""
+
+import os
+import pytest
+
+from time import perf_counter
+
+
+benchmark = pytest.mark.skipif(
+    not os.environ.get('BENCHMARK'),
+    reason="benchmarks are only run with BENCHMARK=1"
+)
+
+
+def measure(function, *args, repeat=1, **kwargs):
+    """ Calls the given function `repeat` times and returns the last result
+    and the fastest of the durations (in seconds).
+
+    """
+
+    best = None
+
+    for _ in range(repeat):
+        start = perf_counter()
+        result = function(*args, **kwargs)
+        duration = perf_counter() - start
+
+        if best is None or duration < best:
+            best = duration
+
+    return result, best
+
+
+def report(title, timings):
+    """ Prints the given timings (name -> seconds). """
+
+    print('')
+    print(title)
+
+    for name, duration in timings.items():
+        print(f"  {name}: {duration * 1000:.1f}ms")
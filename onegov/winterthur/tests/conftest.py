@@ -1,13 +1,21 @@
 import pytest
+import textwrap
 import transaction
 
+from decimal import Decimal
 from onegov.core.csv import CSVFile
 from onegov.core.utils import module_path
+from onegov.directory import DirectoryCollection
+from onegov.directory import DirectoryConfiguration
+from onegov.org.models import Organisation
 from onegov.user import User
 from onegov.winterthur import WinterthurApp
 from onegov.winterthur.initial_content import create_new_organisation
+from onegov.winterthur.roadwork import RoadworkClient
+from onegov.winterthur.tests.fake_pdb import FakePDB
 from onegov_testing.utils import create_app
 from pathlib import Path
+from pytest_localserver.http import WSGIServer
 
 
 @pytest.fixture()
@@ -27,6 +35,138 @@ def addresses_csv(fixtures):
         yield CSVFile(f)
 
 
+@pytest.yield_fixture(scope='function')
+def fake_pdb():
+    pdb = FakePDB()
+
+    server = WSGIServer(application=pdb)
+    server.start()
+
+    pdb.url = server.url
+
+    yield pdb
+
+    pdb.open.set()
+    server.stop()
+
+
+@pytest.yield_fixture(scope='function')
+def roadwork_app(winterthur_app, fake_pdb):
+    winterthur_app.roadwork_client = RoadworkClient(
+        cache=winterthur_app.roadwork_cache,
+        hostname='pdb.example.org',
+        endpoint=fake_pdb.url.replace('http://', ''),
+        username='username',
+        password='password',
+        connect_timeout=1,
+        timeout=5
+    )
+
+    yield winterthur_app
+
+
+@pytest.fixture(scope='function')
+def daycare_app(winterthur_app):
+    app = winterthur_app
+
+    session = app.session()
+
+    dirs = DirectoryCollection(session, type='extended')
+    directory = dirs.add(
+        title="Daycare Centers",
+        structure=textwrap.dedent("""
+            Name *= ___
+            Webseite = https://
+            Tagestarif *= 0..1000
+            Öffnungswochen *= 0..52
+        """),
+        configuration=DirectoryConfiguration(
+            title="[Name]",
+            order=('Name', ),
+        ))
+
+    # Some actual daycare centers in Winterthur
+    directory.add(values=dict(
+        name="Pinochio",
+        tagestarif=98,
+        offnungswochen=49,
+        webseite="",
+    ))
+
+    directory.add(values=dict(
+        name="Fantasia",
+        tagestarif=108,
+        offnungswochen=51,
+        webseite="",
+    ))
+
+    directory.add(values=dict(
+        name="Kinderhaus",
+        tagestarif=110,
+        offnungswochen=50,
+        webseite="",
+    ))
+
+    directory.add(values=dict(
+        name="Luftibus",
+        tagestarif=110,
+        offnungswochen=51,
+        webseite="",
+    ))
+
+    directory.add(values=dict(
+        name="Child Care Corner",
+        tagestarif=125,
+        offnungswochen=51,
+        webseite="",
+    ))
+
+    directory.add(values=dict(
+        name="Apfelblüte",
+        tagestarif=107,
+        offnungswochen=51,
+        webseite="",
+    ))
+
+    directory.add(values=dict(
+        name="Am Park",
+        tagestarif=120,
+        offnungswochen=49,
+        webseite="",
+    ))
+
+    org = session.query(Organisation).one()
+    org.meta['daycare_settings'] = {
+        'rebate': Decimal('5.00'),
+        'max_rate': Decimal('107'),
+        'min_rate': Decimal('15'),
+        'max_income': Decimal('75000'),
+        'max_wealth': Decimal('154000'),
+        'min_income': Decimal('20000'),
+        'max_subsidy': Decimal('92'),
+        'wealth_premium': Decimal('10.00'),
+        'directory': directory.id.hex,
+        'services': textwrap.dedent("""
+            - titel: "Ganzer Tag inkl. Mitagessen"
+              tage: "Montag, Dienstag, Mittwoch, Donnerstag, Freitag"
+              prozent: 100.00
+
+            - titel: "Vor- oder Nachmittag inkl. Mitagessen"
+              tage: "Montag, Dienstag, Mittwoch, Donnerstag, Freitag"
+              prozent: 75.00
+
+            - titel: "Vor- oder Nachmittag ohne Mitagessen"
+              tage: "Montag, Dienstag, Mittwoch, Donnerstag, Freitag"
+              prozent: 50.00
+        """)
+    }
+
+    transaction.commit()
+    session.close_all()
+
+    return app
+
+
 @pytest.yield_fixture(scope='function')
 def winterthur_app(request):
     yield create_winterthur_app(request, use_elasticsearch=False)
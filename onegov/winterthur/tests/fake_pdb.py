@@ -0,0 +1,134 @@
+""" A local stand-in for the PDB OData service, used to test and benchmark
+the roadwork client without access to Winterthur's network.
+
+"""
+
+import json
+import re
+
+from datetime import date, timedelta
+from random import Random
+from threading import Event
+from time import sleep
+
+
+class FakePDB(object):
+    """ A WSGI application serving `odata/Baustellen` and
+    `odata/Baustellen(<id>)`, like the PDB service.
+
+    :param size:
+        The number of projects served.
+
+    :param sections:
+        The number of sections per project.
+
+    :param latency:
+        The time spent on each request, in seconds.
+
+    :param error_rate:
+        The share of requests answered with an internal server error
+        (0.0 - 1.0).
+
+    The service may be taken down by setting `down` to True, after which
+    all requests are answered with 503. Requests may be held back by
+    clearing the `open` event, until it is set again.
+
+    """
+
+    detail = re.compile(r'^/odata/Baustellen\((\d+)\)$')
+
+    def __init__(self, size=100, sections=3, latency=0.0, error_rate=0.0,
+                 seed=0):
+
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = Random(seed)
+        self.down = False
+        self.requests = 0
+
+        self.open = Event()
+        self.open.set()
+
+        self.records = [
+            self.record(id, sections) for id in range(1, size + 1)
+        ]
+        self.records_by_id = {r['Id']: r for r in self.records}
+
+    def record(self, id, sections):
+        start = date.today() - timedelta(days=self.random.randint(1, 30))
+        end = date.today() + timedelta(days=self.random.randint(1, 90))
+
+        def dates(start, end):
+            return {
+                'DauerVon': f'{start.isoformat()}T00:00:00+00:00',
+                'DauerBis': f'{end.isoformat()}T23:59:59+00:00',
+            }
+
+        return {
+            'Id': id,
+            'Internet': self.random.random() > 0.1,
+            'ProjektBezeichnung': f'{self.street()} {id}',
+            'ProjektBereich': self.random.choice((None, 'Werkleitungen')),
+            'SachbearbeiterBau': 'Muster Max',
+            'SachbearbeiterBauZusatz': None,
+            'SachbearbeiterVerkehr': None,
+            'SachbearbeiterVerkehrZusatz': None,
+            'Massnahmen': 'Einspurig befahrbar',
+            'UrlStadtplan': None,
+            'Teilbaustellen': [
+                {
+                    'TeilbaustelleId': id * 1000 + section,
+                    'ProjektBezeichnung': f'Abschnitt {section}',
+                    'ProjektBereich': None,
+                    **dates(start, end)
+                } for section in range(1, sections + 1)
+            ],
+            **dates(start, end)
+        }
+
+    def street(self):
+        return self.random.choice((
+            'Marktgasse',
+            'Obertor',
+            'Steinberggasse',
+            'Technikumstrasse',
+            'Zürcherstrasse',
+        ))
+
+    def __call__(self, environ, start_response):
+        self.requests += 1
+        self.open.wait()
+
+        if self.latency:
+            sleep(self.latency)
+
+        if self.down:
+            return self.respond(start_response, '503 Service Unavailable')
+
+        if self.error_rate and self.random.random() < self.error_rate:
+            return self.respond(start_response, '500 Internal Server Error')
+
+        path = environ['PATH_INFO']
+
+        if path == '/odata/Baustellen':
+            return self.respond(start_response, '200 OK', self.records)
+
+        match = self.detail.match(path)
+
+        if match:
+            record = self.records_by_id.get(int(match.group(1)))
+            records = record and [record] or []
+
+            return self.respond(start_response, '200 OK', records)
+
+        return self.respond(start_response, '404 Not Found')
+
+    def respond(self, start_response, status, records=None):
+        body = json.dumps({'value': records or []}).encode('utf-8')
+
+        start_response(status, [
+            ('Content-Type', 'application/json'),
+            ('Content-Length', str(len(body)))
+        ])
+
+        return [body]
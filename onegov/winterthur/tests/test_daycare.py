@@ -1,114 +1,36 @@
+import csv
+import os
 import pytest
-import textwrap
 import transaction
-
-from decimal import Decimal
-from onegov.directory import DirectoryCollection
-from onegov.directory import DirectoryConfiguration
-from onegov.org.models import Organisation
+import yaml
+
+from click.testing import CliRunner
+from collections import OrderedDict
+from decimal import Decimal, localcontext
+from onegov.directory import DirectoryEntry
+from onegov.winterthur.cli import cli
+from onegov.winterthur.cli import init_simulation, simulate_household
+from onegov.winterthur.daycare import Block, Result
+from onegov.winterthur.daycare import CalculationCache
+from onegov.winterthur.daycare import Daycare
 from onegov.winterthur.daycare import DaycareSubsidyCalculator, Services
+from onegov.winterthur.daycare import CENTS, ZERO
+from onegov.winterthur.daycare import FixedPointSubsidyEngine
+from onegov.winterthur.daycare import PiecewiseLinear
+from onegov.winterthur.daycare import Settings, SettingsImpact
+from onegov.winterthur.daycare import SubsidyEngine
+from onegov.winterthur.daycare import calculation_cache
+from onegov.winterthur.daycare import format_5_cents
+from onegov.winterthur.daycare import format_precise
+from onegov.winterthur.daycare import round_to
+from onegov.winterthur.tests.benchmark import benchmark, measure, report
+from random import Random
+from uuid import uuid4
 
 
 @pytest.fixture(scope='function')
-def app(winterthur_app):
-    app = winterthur_app
-
-    session = app.session()
-
-    dirs = DirectoryCollection(session, type='extended')
-    directory = dirs.add(
-        title="Daycare Centers",
-        structure=textwrap.dedent("""
-            Name *= ___
-            Webseite = https://
-            Tagestarif *= 0..1000
-            Öffnungswochen *= 0..52
-        """),
-        configuration=DirectoryConfiguration(
-            title="[Name]",
-            order=('Name', ),
-        ))
-
-    # Some actual daycare centers in Winterthur
-    directory.add(values=dict(
-        name="Pinochio",
-        tagestarif=98,
-        offnungswochen=49,
-        webseite="",
-    ))
-
-    directory.add(values=dict(
-        name="Fantasia",
-        tagestarif=108,
-        offnungswochen=51,
-        webseite="",
-    ))
-
-    directory.add(values=dict(
-        name="Kinderhaus",
-        tagestarif=110,
-        offnungswochen=50,
-        webseite="",
-    ))
-
-    directory.add(values=dict(
-        name="Luftibus",
-        tagestarif=110,
-        offnungswochen=51,
-        webseite="",
-    ))
-
-    directory.add(values=dict(
-        name="Child Care Corner",
-        tagestarif=125,
-        offnungswochen=51,
-        webseite="",
-    ))
-
-    directory.add(values=dict(
-        name="Apfelblüte",
-        tagestarif=107,
-        offnungswochen=51,
-        webseite="",
-    ))
-
-    directory.add(values=dict(
-        name="Am Park",
-        tagestarif=120,
-        offnungswochen=49,
-        webseite="",
-    ))
-
-    org = session.query(Organisation).one()
-    org.meta['daycare_settings'] = {
-        'rebate': Decimal('5.00'),
-        'max_rate': Decimal('107'),
-        'min_rate': Decimal('15'),
-        'max_income': Decimal('75000'),
-        'max_wealth': Decimal('154000'),
-        'min_income': Decimal('20000'),
-        'max_subsidy': Decimal('92'),
-        'wealth_premium': Decimal('10.00'),
-        'directory': directory.id.hex,
-        'services': textwrap.dedent("""
-            - titel: "Ganzer Tag inkl. Mitagessen"
-              tage: "Montag, Dienstag, Mittwoch, Donnerstag, Freitag"
-              prozent: 100.00
-
-            - titel: "Vor- oder Nachmittag inkl. Mitagessen"
-              tage: "Montag, Dienstag, Mittwoch, Donnerstag, Freitag"
-              prozent: 75.00
-
-            - titel: "Vor- oder Nachmittag ohne Mitagessen"
-              tage: "Montag, Dienstag, Mittwoch, Donnerstag, Freitag"
-              prozent: 50.00
-        """)
-    }
-
-    transaction.commit()
-    session.close_all()
-
-    return app
+def app(daycare_app):
+    return daycare_app
 
 
 def test_calculate_example_1(app):
@@ -419,3 +341,760 @@ def test_calculate_example_5(app):
         ("Elternbeitrag pro Monat", Decimal('661.50')),
         ("Städtischer Beitrag pro Monat", Decimal('563.50')),
     ]
+
+
+def test_calculate_many(app):
+    calculator = DaycareSubsidyCalculator(app.session())
+
+    services = Services.from_org(app.org)
+    services.select('ganzer-tag-inkl-mitagessen', 'mo')
+    services.select('vor-oder-nachmittag-inkl-mitagessen', 'di')
+    services.select('vor-oder-nachmittag-ohne-mitagessen', 'mi')
+
+    incomes = [Decimal(i) for i in range(0, 100000, 1237)]
+    wealths = [Decimal(w) for w in range(0, 400000, 5000)][:len(incomes)]
+    rebates = [i % 2 == 0 for i in range(len(incomes))]
+
+    for daycare in calculator.daycares.values():
+        grid = calculator.calculate_many(
+            daycare=daycare,
+            incomes=incomes,
+            wealths=wealths,
+            services_totals=services.total,
+            rebates=rebates)
+
+        for ix, (income, wealth, rebate) in enumerate(
+                zip(incomes, wealths, rebates)):
+
+            calculation = calculator.calculate(
+                daycare=daycare,
+                services=services,
+                income=income,
+                wealth=wealth,
+                rebate=rebate)
+
+            actual, monthly = calculation.blocks[3:]
+
+            assert grid.parent_share_per_day[ix] == actual.results[2].amount
+            assert grid.city_share_per_day[ix] == actual.results[3].amount
+            assert grid.parent_share_per_month[ix] \
+                == monthly.results[2].amount
+            assert grid.city_share_per_month[ix] \
+                == monthly.results[3].amount
+
+    grid = calculator.calculate_many(
+        daycare=calculator.daycare_by_title("Fantasia"),
+        incomes=Decimal('75000'),
+        wealths=Decimal('150000'),
+        services_totals=Decimal('500'),
+        rebates=True)
+
+    assert grid.parent_share_per_month == (Decimal('2181.31'), )
+    assert grid.city_share_per_month == (Decimal('113.69'), )
+
+    with pytest.raises(ValueError):
+        calculator.calculate_many(
+            daycare=calculator.daycare_by_title("Fantasia"),
+            incomes=incomes,
+            wealths=wealths[:2],
+            services_totals=Decimal('500'),
+            rebates=True)
+
+
+def test_daycares_cache(app):
+    calculator = DaycareSubsidyCalculator(
+        app.session(), cache=app.daycare_cache)
+
+    assert len(calculator.daycares) == 7
+    revision = calculator.directory_revision
+
+    # as long as nothing changes, the directory is not read again
+    calculator = DaycareSubsidyCalculator(
+        app.session(), cache=app.daycare_cache)
+    calculator.load_daycares = None
+
+    assert calculator.directory_revision == revision
+    assert len(calculator.daycares) == 7
+
+    # removing an entry changes the revision
+    session = app.session()
+    session.delete(
+        session.query(DirectoryEntry).filter_by(title="Pinochio").one())
+    transaction.commit()
+
+    calculator = DaycareSubsidyCalculator(
+        app.session(), cache=app.daycare_cache)
+
+    assert calculator.directory_revision != revision
+    assert len(calculator.daycares) == 6
+    assert "Pinochio" not in {d.title for d in calculator.daycares.values()}
+
+
+def test_services_catalogue(app):
+    a = Services.from_org(app.org)
+    b = Services.from_org(app.org)
+
+    # the catalogue is shared, the selection is not
+    assert a.available is b.available
+    assert tuple(a.available) == (
+        'ganzer-tag-inkl-mitagessen',
+        'vor-oder-nachmittag-inkl-mitagessen',
+        'vor-oder-nachmittag-ohne-mitagessen',
+    )
+
+    a.select('ganzer-tag-inkl-mitagessen', 0)
+    assert a.is_selected('ganzer-tag-inkl-mitagessen', 0)
+    assert not b.is_selected('ganzer-tag-inkl-mitagessen', 0)
+    assert a.total == Decimal('100')
+    assert b.total == 0
+
+    with pytest.raises(TypeError):
+        a.available['foo'] = None
+
+
+def test_calculate_summary(app):
+    calculator = DaycareSubsidyCalculator(app.session())
+
+    services = Services.from_org(app.org)
+    services.select('ganzer-tag-inkl-mitagessen', 'mo')
+    services.select('vor-oder-nachmittag-inkl-mitagessen', 'di')
+
+    for daycare in calculator.daycares.values():
+        for income in range(0, 100000, 2500):
+            for wealth in (0, 200000):
+                arguments = dict(
+                    daycare=daycare,
+                    services=services,
+                    income=Decimal(income),
+                    wealth=Decimal(wealth),
+                    rebate=income % 2 == 0,
+                )
+
+                full = calculator.calculate(**arguments)
+                summary = calculator.calculate(**arguments, summary_only=True)
+
+                assert full.parent_share_per_month \
+                    == format_5_cents(summary.parent_share_per_month)
+                assert full.city_share_per_month \
+                    == format_5_cents(summary.city_share_per_month)
+                assert full.total_per_month \
+                    == format_5_cents(summary.total_per_month)
+
+                assert not hasattr(summary, 'blocks')
+                assert not hasattr(summary, 'agenda')
+
+
+def test_calculate_summary_without_blocks(app, monkeypatch):
+    calculator = DaycareSubsidyCalculator(app.session())
+
+    services = Services.from_org(app.org)
+    services.select('ganzer-tag-inkl-mitagessen', 'mo')
+
+    arguments = dict(
+        daycare=calculator.daycare_by_title("Fantasia"),
+        services=services,
+        income=Decimal('50000'),
+        wealth=Decimal('200000'),
+        rebate=True,
+    )
+
+    created = {'blocks': 0, 'results': 0}
+
+    def count(cls, key):
+        init = cls.__init__
+
+        def counted(self, *args, **kwargs):
+            created[key] += 1
+            init(self, *args, **kwargs)
+
+        monkeypatch.setattr(cls, '__init__', counted)
+
+    count(Block, 'blocks')
+    count(Result, 'results')
+
+    calculator.calculate(**arguments)
+    assert created['blocks'] and created['results']
+
+    created['blocks'] = created['results'] = 0
+
+    # the summary skips the blocks and results of the full calculation
+    calculator.calculate(**arguments, summary_only=True)
+    assert created == {'blocks': 0, 'results': 0}
+
+
+@benchmark
+def test_calculate_summary_benchmark(app):
+    calculator = DaycareSubsidyCalculator(app.session())
+
+    services = Services.from_org(app.org)
+    services.select('ganzer-tag-inkl-mitagessen', 'mo')
+
+    arguments = dict(
+        daycare=calculator.daycare_by_title("Fantasia"),
+        services=services,
+        income=Decimal('50000'),
+        wealth=Decimal('200000'),
+        rebate=True,
+    )
+
+    def calculate(number, **options):
+        for _ in range(number):
+            calculator.calculate(**arguments, **options)
+
+    timings = {}
+    timings['full'] = measure(calculate, 250, repeat=5)[1]
+    timings['summary'] = measure(
+        calculate, 250, summary_only=True, repeat=5)[1]
+
+    report("250 calculations", timings)
+    print(f"  speedup: {timings['full'] / timings['summary']:.1f}x")
+
+
+def test_compare(app):
+    calculator = DaycareSubsidyCalculator(app.session())
+
+    services = Services.from_org(app.org)
+    for day in ('mo', 'di', 'mi', 'do', 'fr'):
+        services.select('ganzer-tag-inkl-mitagessen', day)
+
+    comparison = calculator.compare(
+        services=services,
+        income=Decimal('75000'),
+        wealth=Decimal('150000'),
+        rebate=True)
+
+    assert len(comparison) == 7
+
+    results = {r.daycare.title: r for r in comparison}
+    assert results["Fantasia"].parent_share_per_month == Decimal('2181.30')
+    assert results["Fantasia"].city_share_per_month == Decimal('113.70')
+
+    for result in comparison:
+        calculation = calculator.calculate(
+            daycare=result.daycare,
+            services=services,
+            income=Decimal('75000'),
+            wealth=Decimal('150000'),
+            rebate=True)
+
+        assert calculation.parent_share_per_month \
+            == format_5_cents(result.parent_share_per_month)
+        assert calculation.city_share_per_month \
+            == format_5_cents(result.city_share_per_month)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_fixed_point_engine(app, seed):
+    random = Random(seed)
+
+    settings = DaycareSubsidyCalculator(app.session()).settings
+    settings.rebate = Decimal(random.randint(0, 5000)) / 100
+    settings.min_rate = Decimal(random.randint(0, 30))
+    settings.max_rate = Decimal(random.randint(50, 130))
+    settings.max_subsidy = Decimal(random.randint(10, 120))
+    settings.wealth_premium = Decimal(random.randint(0, 3000)) / 100
+
+    for ix in range(250):
+        daycare = Daycare(
+            id=ix,
+            title="Daycare",
+            rate=Decimal(random.randint(1000, 15000)) / 100,
+            weeks=random.randint(1, 52))
+
+        precise = SubsidyEngine(settings, daycare)
+        fixed = FixedPointSubsidyEngine(settings, daycare)
+
+        assert fixed.exact
+
+        for _ in range(10):
+            household = (
+                Decimal(random.randint(0, 20000000)) / 100,
+                Decimal(random.randint(0, 80000000)) / 100,
+                Decimal(random.randint(0, 70000)) / 100,
+                random.choice((True, False))
+            )
+
+            assert precise.shares(*household) == fixed.shares(*household)
+
+    # values that cannot be represented are calculated by the decimal engine
+    daycare = Daycare(id=1, title="Daycare", rate=Decimal('110'), weeks=49)
+
+    precise = SubsidyEngine(settings, daycare)
+    fixed = FixedPointSubsidyEngine(settings, daycare)
+
+    household = (Decimal('50000.005'), Decimal('0'), Decimal('500'), True)
+    assert precise.shares(*household) == fixed.shares(*household)
+
+
+def test_fixed_point_weeks_factor(app):
+    settings = DaycareSubsidyCalculator(app.session()).settings
+    daycare = Daycare(id=1, title="Daycare", rate=Decimal('110'), weeks=49)
+    engine = FixedPointSubsidyEngine(settings, daycare)
+
+    # 0.18 * 49 / 12 is exactly 0.735, but the decimal weeks factor is
+    # slightly below 49 / 12, so the decimal result is rounded down
+    assert (Decimal('0.18') * daycare.factor).quantize(Decimal('0.01')) \
+        == Decimal('0.73')
+    assert engine.by_weeks_factor(18, -2) == 73
+
+    # without a tie, the exact division is used
+    assert engine.by_weeks_factor(100, -2) == 408
+
+
+def test_calculator_engine(app):
+    services = Services.from_org(app.org)
+    services.select('ganzer-tag-inkl-mitagessen', 'mo')
+
+    results = []
+
+    for engine in ('decimal', 'fixed'):
+        calculator = DaycareSubsidyCalculator(app.session(), engine=engine)
+        results.append(calculator.compare(
+            services=services,
+            income=Decimal('61000'),
+            wealth=Decimal('264000'),
+            rebate=True
+        ))
+
+    def totals(comparison):
+        return [(
+            r.daycare.title,
+            r.parent_share_per_month,
+            r.city_share_per_month,
+            r.total_per_month
+        ) for r in comparison]
+
+    decimal, fixed = results
+    assert totals(decimal) == totals(fixed)
+
+    with pytest.raises(AssertionError):
+        DaycareSubsidyCalculator(app.session(), engine='float')
+
+
+def test_round_to_and_format_precise():
+    random = Random(0)
+
+    def round_to_reference(n, precision):
+        precision = Decimal(precision)
+        correction = Decimal('0.5') if n >= 0 else Decimal('-0.5')
+
+        return int(n / precision + correction) * precision
+
+    for _ in range(1000):
+        amount = Decimal(random.randint(-10 ** 9, 10 ** 9)) / 10 ** 4
+
+        for precision in ('0.01', '0.05'):
+            assert round_to(amount, precision) \
+                == round_to_reference(amount, precision)
+
+    # the precision of the current context does not change the format
+    amount = Decimal('1234567.123456789')
+    expected = format_precise(amount)
+    assert expected.endswith('567.123456789')
+
+    with localcontext() as ctx:
+        ctx.prec = 4
+        assert format_precise(amount) == expected
+
+    assert format_precise(ZERO) == '0.00'
+
+
+def test_simulate_household(app):
+    calculator = DaycareSubsidyCalculator(app.session())
+
+    init_simulation(
+        settings=calculator.settings,
+        daycares=calculator.daycares_by_title,
+        services=calculator.settings.services,
+        engine='fixed')
+
+    result = simulate_household({
+        'income': '75000',
+        'wealth': '150000',
+        'daycare': 'Fantasia',
+        'services': 'ganzer-tag-inkl-mitagessen: mo, di, mi, do, fr',
+        'rebate': '1'
+    })
+
+    assert result['parent_share_per_month'] == Decimal('2181.30')
+    assert result['city_share_per_month'] == Decimal('113.70')
+    assert result['total_per_month'] == Decimal('2295.00')
+    assert result['error'] == ''
+
+    result = simulate_household({
+        'income': '75000',
+        'wealth': '150000',
+        'daycare': 'Fantasia',
+        'services': 'ganzer-tag: mo',
+        'rebate': '1'
+    })
+
+    assert result['error'] == 'ValueError: Unknown service: ganzer-tag'
+
+    result = simulate_household({
+        'income': '75000',
+        'wealth': '150000',
+        'daycare': 'Sunshine',
+        'services': 'ganzer-tag-inkl-mitagessen: mo',
+        'rebate': '1'
+    })
+
+    assert result['error'] == "KeyError: 'Sunshine'"
+
+    # csv.DictReader sets the missing values of short rows to None
+    result = simulate_household({
+        'income': '75000',
+        'wealth': '150000',
+        'daycare': 'Fantasia',
+        'services': None,
+        'rebate': None
+    })
+
+    assert result['error'] == 'ValueError: Missing value: services'
+    assert 'parent_share_per_month' not in result
+
+    result = simulate_household({
+        'income': '75000',
+        'wealth': None,
+        'daycare': None,
+        'services': None,
+        'rebate': None
+    })
+
+    assert result['error'] == 'ValueError: Missing value: daycare'
+
+    # surplus values are stored under None
+    result = simulate_household({
+        'income': '75000',
+        'wealth': '150000',
+        'daycare': 'Fantasia',
+        'services': 'ganzer-tag-inkl-mitagessen: mo',
+        'rebate': '1',
+        None: ['foo']
+    })
+
+    assert result['error'] == 'ValueError: Surplus values: foo'
+    assert None not in result
+
+    # daycares sharing a title are ambiguous
+    init_simulation(
+        settings=calculator.settings,
+        daycares={**calculator.daycares_by_title, 'Fantasia': None},
+        services=calculator.settings.services,
+        engine='decimal')
+
+    result = simulate_household({
+        'income': '75000',
+        'wealth': '150000',
+        'daycare': 'Fantasia',
+        'services': 'ganzer-tag-inkl-mitagessen: mo',
+        'rebate': '1'
+    })
+
+    assert result['error'] == 'ValueError: Ambiguous daycare: Fantasia'
+
+
+def test_daycares_by_title(app):
+    calculator = DaycareSubsidyCalculator(app.session())
+    assert calculator.ambiguous_titles == []
+
+    first, second, *rest = calculator.daycares.values()
+    duplicate = Daycare(
+        id=uuid4(), title=first.title, rate=second.rate, weeks=second.weeks)
+
+    calculator = DaycareSubsidyCalculator(app.session())
+    calculator.daycares = OrderedDict(
+        (d.id, d) for d in (first, duplicate, second, *rest))
+
+    # the first daycare with a title is used
+    assert calculator.ambiguous_titles == [first.title]
+    assert calculator.daycare_by_title(first.title) is first
+    assert len(calculator.daycares_by_title) == 7
+
+
+def test_simulate_daycare_subsidies_command(
+        app, postgres_dsn, redis_url, temporary_directory):
+
+    cfg_path = os.path.join(temporary_directory, 'onegov.yml')
+
+    with open(cfg_path, 'w') as f:
+        f.write(yaml.dump({
+            'applications': [
+                {
+                    'path': f'/{app.namespace}/*',
+                    'application': 'onegov.winterthur.WinterthurApp',
+                    'namespace': app.namespace,
+                    'configuration': {
+                        'dsn': postgres_dsn,
+                        'depot_backend': 'depot.io.memory.MemoryFileStorage',
+                        'redis_url': redis_url,
+                    }
+                }
+            ]
+        }))
+
+    input_file = os.path.join(temporary_directory, 'households.csv')
+    output_file = os.path.join(temporary_directory, 'shares.csv')
+
+    def simulate(*households):
+        with open(input_file, 'w', newline='') as f:
+            f.write(''.join(f'{h}\n' for h in households))
+
+        return CliRunner().invoke(cli, [
+            '--config', cfg_path,
+            '--select', f'/{app.application_id}',
+            'simulate-daycare-subsidies',
+            '--input-file', input_file,
+            '--output-file', output_file,
+            '--processes', '2',
+            '--batch-size', '2',
+        ])
+
+    service = 'ganzer-tag-inkl-mitagessen: mo, di, mi, do, fr'
+
+    result = simulate(
+        'income,wealth,daycare,services,rebate',
+        f'75000,150000,Fantasia,{service},1',
+        f'75000,150000,Fantasia,{service},1',
+        f'50000,0,Pinochio,{service},0',
+        f'50000,0,Sunshine,{service},0',
+        '50000,0',
+    )
+    assert result.exit_code == 0, result.output
+
+    with open(output_file, newline='') as f:
+        rows = list(csv.DictReader(f))
+
+    # the households are written in order, with their shares or an error
+    assert [r['daycare'] for r in rows] == [
+        'Fantasia', 'Fantasia', 'Pinochio', 'Sunshine', '']
+    assert rows[0]['city_share_per_month'] == '113.70'
+    assert rows[1] == rows[0]
+    assert rows[3]['error'] == "KeyError: 'Sunshine'"
+    assert rows[4]['error'] == 'ValueError: Missing value: daycare'
+
+    city_share = sum(Decimal(r['city_share_per_month']) for r in rows[:3])
+    parent_share = sum(Decimal(r['parent_share_per_month']) for r in rows[:3])
+
+    assert "Households: 5" in result.output
+    assert "Errors: 2" in result.output
+    assert f"Parent share per month: {parent_share} CHF" in result.output
+    assert f"City share per month: {city_share} CHF" in result.output
+    assert f"City share per year: {city_share * 12} CHF" in result.output
+
+    # an empty file is rejected, without writing any output
+    os.remove(output_file)
+
+    result = simulate()
+    assert result.exit_code != 0
+    assert "is empty" in result.output
+    assert not os.path.exists(output_file)
+
+
+def test_settings_impact(app):
+    calculator = DaycareSubsidyCalculator(app.session())
+    daycares = calculator.daycares.values()
+
+    old = calculator.settings
+
+    # without changes, there is no impact
+    impact = SettingsImpact(old, old, daycares).summary()
+    assert impact['total']['households'] == 7 * 101 * 5
+    assert impact['total']['changed'] == 0
+    assert impact['total']['min'] == impact['total']['max'] == 0
+
+    # raising the maximum income raises the city share
+    new = Settings(settings={
+        **app.org.meta['daycare_settings'],
+        'max_income': Decimal('80000')
+    })
+
+    impact = SettingsImpact(old, new, daycares).summary()
+    assert impact['total']['changed'] > 0
+    assert impact['total']['min'] == 0
+    assert impact['total']['max'] > 0
+    assert len(impact['daycares']) == 7
+
+    # raising the minimum rate lowers the city share
+    new = Settings(settings={
+        **app.org.meta['daycare_settings'],
+        'min_rate': Decimal('20')
+    })
+
+    impact = SettingsImpact(old, new, daycares).summary()
+    assert impact['total']['min'] < 0
+    assert impact['total']['max'] == 0
+
+
+def test_calculation_cache(app):
+    calculations = CalculationCache()
+
+    def calculate(income, **settings):
+        calculator = DaycareSubsidyCalculator(
+            app.session(),
+            cache=app.daycare_cache,
+            calculations=calculations)
+
+        for key, value in settings.items():
+            setattr(calculator.settings, key, value)
+
+        services = Services.from_org(app.org)
+        services.select('ganzer-tag-inkl-mitagessen', 0)
+
+        return calculator.calculate(
+            daycare=calculator.daycare_by_title("Fantasia"),
+            services=services,
+            income=income,
+            wealth=Decimal('0'),
+            rebate=False)
+
+    first = calculate(Decimal('50000'))
+    assert calculations.misses == 1
+    assert calculations.hits == 0
+
+    assert calculate(Decimal('50000')) is first
+    assert calculations.misses == 1
+    assert calculations.hits == 1
+
+    assert calculate(Decimal('60000')) is not first
+    assert calculations.misses == 2
+    assert len(calculations) == 2
+
+    # changed settings evict the existing entries
+    calculate(Decimal('50000'), min_rate=Decimal('20'))
+    assert calculations.misses == 3
+    assert calculations.evictions == 2
+    assert len(calculations) == 1
+
+    # as does a changed directory
+    session = app.session()
+    session.delete(
+        session.query(DirectoryEntry).filter_by(title="Pinochio").one())
+    transaction.commit()
+
+    calculate(Decimal('50000'), min_rate=Decimal('20'))
+    assert calculations.misses == 4
+    assert calculations.evictions == 3
+
+    # by default, the process-wide calculation cache is used
+    calculator = DaycareSubsidyCalculator(app.session())
+    assert calculator.calculations is calculation_cache
+
+    # without a cache, the calculation cache is not used
+    calculator = DaycareSubsidyCalculator(
+        app.session(), calculations=calculations)
+    calculator.calculate(
+        daycare=calculator.daycare_by_title("Fantasia"),
+        services=Services.from_org(app.org),
+        income=Decimal('50000'),
+        wealth=Decimal('0'),
+        rebate=False)
+
+    assert calculations.misses == 4
+    assert calculations.hits == 1
+
+
+def test_calculation_cache_limits():
+    cache = CalculationCache(maxsize=2, ttl=60)
+
+    cache.get_or_create('scope', 1, 'a', lambda: 'a')
+    cache.get_or_create('scope', 1, 'b', lambda: 'b')
+    cache.get_or_create('scope', 1, 'a', lambda: 'a')
+    cache.get_or_create('scope', 1, 'c', lambda: 'c')
+
+    # b was the least recently used entry
+    assert [k for s, k in cache.entries] == [
+        cache.digest('a'), cache.digest('c')]
+    assert cache.evictions == 1
+
+    # outdated entries are created again
+    cache.ttl = -1
+    assert cache.get_or_create('scope', 1, 'a', lambda: 'x') == 'x'
+    assert cache.hits == 1
+    assert cache.misses == 4
+
+    # scopes are evicted separately
+    cache.maxsize = 10
+    cache.get_or_create('other', 1, 'a', lambda: 'a')
+    cache.get_or_create('scope', 2, 'a', lambda: 'a')
+
+    assert sorted(cache.entries) == [
+        ('other', cache.digest('a')), ('scope', cache.digest('a'))]
+
+    # the keys are not stored as they are
+    assert cache.digest('a') != 'a'
+    assert cache.digest('a') != CalculationCache().digest('a')
+
+    # calculations of an outdated revision are not stored
+    def create():
+        cache.get_or_create('scope', 3, 'b', lambda: 'b')
+        return 'x'
+
+    assert cache.get_or_create('scope', 2, 'c', create) == 'x'
+    assert sorted(cache.entries) == [
+        ('other', cache.digest('a')), ('scope', cache.digest('b'))]
+
+
+def test_piecewise_linear():
+    f = PiecewiseLinear(((Decimal('10'), Decimal('0')), (0, Decimal('10'))))
+
+    assert f(-5) == 10
+    assert f(0) == 10
+    assert f(Decimal('2.5')) == Decimal('7.5')
+    assert f(10) == 0
+    assert f(20) == 0
+
+    assert f.solve(10) == 0
+    assert f.solve(5) == 5
+    assert f.solve(0) == 10
+    assert f.solve(20) is None
+
+    assert f.scaled(2)(5) == 10
+
+
+@pytest.mark.parametrize('rebate', [False, True])
+def test_subsidy_model(app, rebate):
+    calculator = DaycareSubsidyCalculator(app.session())
+    engine = SubsidyEngine(
+        calculator.settings, calculator.daycare_by_title("Fantasia"))
+    model = calculator.subsidy_model(engine.daycare, rebate)
+
+    # the model is exact, up to the rounding of each step
+    random = Random(42)
+
+    for i in range(1000):
+        income = Decimal(random.randint(0, 10_000_000)) / 100
+        wealth = Decimal(random.randint(0, 1_000_000))
+
+        expected = engine.shares(income, wealth, Decimal('100'), rebate)
+        actual = model.shares(income, wealth, Decimal('100'))
+
+        for e, a in zip(expected, actual):
+            assert abs(e - a) <= Decimal('0.05')
+
+    # the city share drops linearly, up to the last breakpoint
+    assert model.breakpoints[0] == 0
+    assert model.city_share_per_day(0) == Decimal('92.00')
+
+    if rebate:
+        # with a rebate, the parents never pay the full rate
+        assert model.city_share_per_day(model.breakpoints[-1]) > 0
+        assert model.break_even_income() is None
+        assert model.exact_break_even_income() is None
+        return
+
+    income = model.break_even_income()
+    exact = model.exact_break_even_income()
+
+    # the rounding of each step shifts the income by a few francs
+    assert abs(income - exact) < Decimal('0.05') / model.factor
+    assert engine.shares(exact, ZERO, Decimal('100'), rebate)[1] == 0
+    assert engine.shares(exact - CENTS, ZERO, Decimal('100'), rebate)[1] > 0
+
+    # the wealth premium lowers the income
+    wealthy = model.exact_break_even_income(wealth=Decimal('254000'))
+    assert wealthy == exact - Decimal('10000')
+
+    # half the subsidy is paid in the middle of the linear part
+    half = model.income_for_city_share(Decimal('46'))
+    assert abs(model.shares(half, ZERO, Decimal('100'))[1] - 46) < CENTS
@@ -1,7 +1,15 @@
 import math
 import pytest
+import transaction
 
+from io import BytesIO
+from onegov.core.csv import CSVFile
 from onegov.winterthur.collections import AddressCollection
+from onegov.winterthur.collections.address import CSVStream
+from onegov.winterthur.models import WinterthurAddress
+from onegov.winterthur.tests.benchmark import benchmark, measure, report
+from pytest_localserver.http import WSGIServer
+from time import sleep
 
 
 @pytest.mark.xfail(reason="the remote host providing the csv might be down")
@@ -41,3 +49,372 @@ def test_update_addresses(session, streets_csv, addresses_csv):
     # check the encoding
     a = addresses.query().filter_by(street="Alte Römerstrasse").first()
     assert a.street == "Alte Römerstrasse"
+
+
+def test_import_addresses(session, fixtures):
+
+    def import_addresses():
+        with (fixtures / 'streets.csv').open('rb') as streets:
+            with (fixtures / 'addresses.csv').open('rb') as addresses:
+                collection.delete_existing()
+                collection.import_from_csv(
+                    CSVFile(streets), CSVFile(addresses))
+
+    collection = AddressCollection(session)
+
+    import_addresses()
+    count = collection.query().count()
+
+    # the full dataset of Winterthur
+    assert count >= 18_000
+
+    a = collection.query().filter_by(id=9236).one()
+    assert a.street == 'Ackeretstrasse'
+    assert a.house_extra == ''
+    assert a.zipcode_extra == 0
+
+    # streets without addresses
+    a = collection.query().filter_by(house_number=-1).first()
+    assert a.is_addressless
+    assert a.house_extra is None
+    assert a.zipcode_extra is None
+
+    # the encoding
+    assert collection.query().filter_by(street="Alte Römerstrasse").first()
+
+    # reimporting replaces the existing records
+    import_addresses()
+    assert collection.query().count() == count
+
+
+@benchmark
+def test_import_addresses_benchmark(session, fixtures):
+    collection = AddressCollection(session)
+
+    def rows():
+        with (fixtures / 'streets.csv').open('rb') as streets:
+            with (fixtures / 'addresses.csv').open('rb') as addresses:
+                yield from collection.rows_from_csv(
+                    CSVFile(streets), CSVFile(addresses))
+
+    def import_with_orm():
+        for address in collection.query():
+            session.delete(address)
+
+        for row in rows():
+            session.add(WinterthurAddress(
+                **dict(zip(collection.copy_columns, row))))
+
+        session.flush()
+
+    def import_with_copy():
+        collection.delete_existing()
+        collection.copy_rows(rows())
+
+    timings = {}
+
+    # each import replaces the records of the previous one
+    for name, function in (
+        ('orm', import_with_orm),
+        ('copy', import_with_copy)
+    ):
+        timings[name] = measure(function, repeat=3)[1]
+        session.expunge_all()
+
+    report(f"{collection.query().count()} addresses", timings)
+
+
+def test_sync_addresses(session):
+
+    def csv(*lines):
+        return CSVFile(BytesIO('\n'.join(lines).encode('iso-8859-1')))
+
+    def streets():
+        return csv(
+            'STRC;ESTRID;BEZ',
+            '20;1013078;"Ackeretstrasse"',
+            '30;1013079;"Adlerstrasse"',
+            '40;1013080;"Alte Römerstrasse"',
+        )
+
+    def addresses(*lines):
+        return csv(
+            'EINID;STRC;HNR;HNRZU;PLZ;PLZZU;ORT;KREISNUMMER;KREISNAME;'
+            'QUARTIERNUMMER;QUARTIERNAME;BETREIBUNGSKREIS',
+            *lines
+        )
+
+    first = '9236;20;1;"";8400;0;"Winterthur";1;"Winterthur-Stadt";160;' \
+        '"Neuwiesen";1'
+    second = '8063;20;2;"";8400;0;"Winterthur";1;"Winterthur-Stadt";160;' \
+        '"Neuwiesen";1'
+    third = '1234;30;5;"a";8400;0;"Winterthur";1;"Winterthur-Stadt";160;' \
+        '"Neuwiesen";1'
+
+    collection = AddressCollection(session)
+
+    # the first run adds everything
+    assert collection.sync_from_csv(
+        streets(), addresses(first, second)) == {
+            'added': 4, 'updated': 0, 'deleted': 0}
+
+    # streets without addresses use the negative street id as id
+    assert {a.id for a in collection.query()} == {9236, 8063, -30, -40}
+    assert collection.query().filter_by(id=-40).one().is_addressless
+    assert collection.query().filter_by(
+        id=-40).one().street == "Alte Römerstrasse"
+
+    # unchanged data results in no changes
+    assert collection.sync_from_csv(
+        streets(), addresses(first, second)) == {
+            'added': 0, 'updated': 0, 'deleted': 0}
+
+    # changed records are updated, missing ones deleted, new ones added
+    changed = first.replace('Neuwiesen', 'Veltheim')
+
+    assert collection.sync_from_csv(
+        streets(), addresses(changed, third)) == {
+            'added': 1, 'updated': 1, 'deleted': 2}
+
+    assert {a.id for a in collection.query()} == {9236, 1234, -40}
+    assert collection.query().filter_by(id=1234).one().house_extra == 'a'
+
+    session.expire_all()
+    assert collection.query().filter_by(id=9236).one().neighbourhood \
+        == 'Veltheim'
+
+
+class FileServer(object):
+    """ Serves the files in the given directory, with etags. """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.requests = []
+        self.etags = {}
+        self.extra = {}
+
+    def __call__(self, environ, start_response):
+        name = environ['PATH_INFO'].lstrip('/')
+        etag = self.etags.setdefault(name, '"1"')
+
+        self.requests.append(name)
+
+        if environ.get('HTTP_IF_NONE_MATCH') == etag:
+            start_response('304 Not Modified', [('ETag', etag)])
+            return [b'']
+
+        if not (self.directory / name).exists():
+            start_response('404 Not Found', [])
+            return [b'']
+
+        body = (self.directory / name).read_bytes() + self.extra.get(name, b'')
+
+        start_response('200 OK', [
+            ('Content-Type', 'text/csv'),
+            ('Content-Length', str(len(body))),
+            ('ETag', etag)
+        ])
+
+        return [body]
+
+
+class DictCache(dict):
+
+    def set(self, key, value):
+        self[key] = value
+
+
+def test_conditional_update(session, fixtures):
+    files = FileServer(fixtures)
+
+    server = WSGIServer(application=files)
+    server.start()
+
+    try:
+        streets = f'{server.url}/streets.csv'
+        addresses = f'{server.url}/addresses.csv'
+
+        cache = DictCache()
+        collection = AddressCollection(session, cache=cache)
+
+        # the first update downloads and imports everything
+        changes = collection.update(streets, addresses)
+        assert changes['added'] >= 18_000
+
+        # the downloads are only remembered once the update is committed,
+        # which is also when the cached listing is invalidated
+        assert streets not in cache
+        assert 'listing-revision' not in cache
+        transaction.commit()
+        assert cache[streets]['etag'] == '"1"'
+        assert cache['listing-revision']
+        assert cache[streets]['digest']
+
+        # the next update is skipped, as neither file was modified
+        del files.requests[:]
+        assert collection.update(streets, addresses) == {
+            'added': 0, 'updated': 0, 'deleted': 0}
+        assert sorted(files.requests) == ['addresses.csv', 'streets.csv']
+        transaction.commit()
+
+        # if only the etag changes, both files are read, but the digest
+        # prevents the changes from being written
+        del files.requests[:]
+        files.etags['streets.csv'] = '"2"'
+
+        assert collection.update(streets, addresses) == {
+            'added': 0, 'updated': 0, 'deleted': 0}
+        assert sorted(files.requests) == [
+            'addresses.csv', 'addresses.csv', 'streets.csv']
+        transaction.commit()
+        assert cache[streets]['etag'] == '"2"'
+
+        # if one file changes, both are downloaded
+        del files.requests[:]
+        revision = cache['listing-revision']
+        files.etags['streets.csv'] = '"3"'
+        files.extra['streets.csv'] = b'99999;;"Teststrasse"\n'
+
+        assert collection.update(streets, addresses) == {
+            'added': 1, 'updated': 0, 'deleted': 0}
+        assert sorted(files.requests) == [
+            'addresses.csv', 'addresses.csv', 'streets.csv']
+        transaction.abort()
+
+        # a rolled back update is not skipped the next time
+        assert cache[streets]['etag'] == '"2"'
+        assert cache['listing-revision'] == revision
+
+        del files.requests[:]
+        assert collection.update(streets, addresses) == {
+            'added': 1, 'updated': 0, 'deleted': 0}
+        assert sorted(files.requests) == [
+            'addresses.csv', 'addresses.csv', 'streets.csv']
+        transaction.commit()
+
+        assert cache[streets]['etag'] == '"3"'
+        assert cache['listing-revision'] != revision
+        assert collection.query().filter_by(id=-99999).one().street \
+            == 'Teststrasse'
+
+        # full updates ignore the cache
+        del files.requests[:]
+        changes = collection.update(streets, addresses, full=True)
+        assert changes['added'] == changes['deleted'] >= 18_000
+        assert sorted(files.requests) == ['addresses.csv', 'streets.csv']
+        transaction.commit()
+
+        # failures are raised
+        with pytest.raises(RuntimeError):
+            collection.update(f'{server.url}/missing.csv', addresses)
+
+    finally:
+        server.stop()
+
+
+def test_csv_stream():
+
+    def application(environ, start_response):
+        text = 'Name;Ort\n"Müller\nHans";Zürich\nMeier;Töss\n'
+        body = text.encode(environ['PATH_INFO'].lstrip('/'))
+
+        start_response('200 OK', [('ETag', '"1"')])
+
+        # deliver the file byte by byte, splitting the multibyte characters
+        return [body[i:i + 1] for i in range(len(body))]
+
+    server = WSGIServer(application=application)
+    server.start()
+
+    try:
+        for encoding in ('utf-8', 'iso-8859-1'):
+
+            # the encoding may be given or detected
+            for given in (encoding, None):
+                stream = CSVStream(f'{server.url}/{encoding}', encoding=given)
+
+                assert stream.wait() == 200
+                assert stream.etag == '"1"'
+                assert stream.digest is None
+
+                lines = list(stream.lines)
+                assert [(line.name, line.ort) for line in lines] == [
+                    ('Müller\nHans', 'Zürich'),
+                    ('Meier', 'Töss')
+                ]
+                assert stream.digest
+                assert stream.encoding == encoding
+
+        # streams may be closed before they are read
+        stream = CSVStream(f'{server.url}/utf-8', encoding='utf-8')
+        stream.wait()
+        stream.close()
+        stream.thread.join(timeout=5)
+
+        assert not stream.thread.is_alive()
+
+    finally:
+        server.stop()
+
+    with pytest.raises(RuntimeError):
+        CSVStream(server.url).wait()
+
+
+def test_csv_stream_format():
+
+    def application(environ, start_response):
+        text = (
+            '\ufeffName, Ort (PLZ)\n'
+            'Meier,Töss\n'
+            'Huber\n'
+            'Müller,Seen,Winterthur\n'
+            'Keller,Wülflingen\n'
+        )
+
+        start_response('200 OK', [])
+        return [text.encode('utf-8')]
+
+    server = WSGIServer(application=application)
+    server.start()
+
+    try:
+        stream = CSVStream(server.url)
+        stream.wait()
+
+        # the delimiter is detected and the headers are normalised, while
+        # rows with a wrong number of values are skipped
+        lines = list(stream.lines)
+        assert [(line.name, line.ort_plz) for line in lines] == [
+            ('Meier', 'Töss'),
+            ('Keller', 'Wülflingen')
+        ]
+        assert stream.malformed == [3, 4]
+
+    finally:
+        server.stop()
+
+
+def test_csv_stream_stalled():
+
+    def application(environ, start_response):
+        start_response('200 OK', [])
+
+        yield b'Name;Ort\nMeier;T\xf6ss\n'
+
+        # the stalled download is aborted, long before this
+        sleep(3)
+
+        yield b'Huber;Seen\n'
+
+    server = WSGIServer(application=application)
+    server.start()
+
+    try:
+        stream = CSVStream(server.url, low_speed_time=1)
+        stream.wait()
+
+        with pytest.raises(RuntimeError):
+            list(stream.lines)
+
+    finally:
+        server.stop()
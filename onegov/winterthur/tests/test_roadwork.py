@@ -0,0 +1,871 @@
+import isodate
+import json
+import pycurl
+import pytest
+
+from datetime import datetime, timedelta
+from onegov.winterthur.roadwork import Roadwork
+from onegov.winterthur.roadwork import RoadworkCircuitBreaker
+from onegov.winterthur.roadwork import RoadworkClient
+from onegov.winterthur.roadwork import RoadworkCollection
+from onegov.winterthur.roadwork import RoadworkConfig
+from onegov.winterthur.roadwork import RoadworkConnectionError
+from onegov.winterthur.tests.benchmark import benchmark, measure, report
+from onegov.winterthur.tests.fake_pdb import FakePDB
+from onegov_testing import Client
+from pathlib import Path
+from threading import Event, Lock, Thread
+from time import monotonic, sleep
+
+
+class DictCache(dict):
+
+    def set(self, key, value):
+        self[key] = value
+
+
+class FakeClient(RoadworkClient):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.requests = 0
+        self.available = True
+        self.release = Event()
+        self.release.set()
+
+    def get_uncached(self, path):
+        self.release.wait()
+        self.requests += 1
+
+        if not self.available:
+            raise pycurl.error()
+
+        return 200, {'value': self.requests}
+
+
+def age(client, path, seconds):
+    client.cache[path]['created'] -= timedelta(seconds=seconds)
+
+
+def wait_for_refresh(client):
+    while client.refreshing:
+        sleep(0.01)
+
+
+def test_roadwork_client_lifetime():
+    client = FakeClient(DictCache(), 'localhost', 'user', 'pass')
+
+    # the first request is synchronous
+    assert client.get('/odata') == {'value': 1}
+    assert client.requests == 1
+
+    # within the lifetime, the cache is used
+    assert client.get('/odata') == {'value': 1}
+    assert client.requests == 1
+
+    # after the lifetime, the stale value is returned immediately
+    client.release.clear()
+    age(client, 'odata', 6 * 60)
+
+    assert client.get('/odata') == {'value': 1}
+    assert client.get('/odata') == {'value': 1}
+    assert client.refreshing == {'odata'}
+
+    # while the refresh happens in the background (only once)
+    thread = client.refresh_in_background('odata')
+    assert thread is None
+
+    client.release.set()
+    wait_for_refresh(client)
+
+    assert client.requests == 2
+    assert client.get('/odata') == {'value': 2}
+
+
+def test_roadwork_client_downtime():
+    client = FakeClient(DictCache(), 'localhost', 'user', 'pass')
+    assert client.get('/odata') == {'value': 1}
+
+    # failed background refreshes are ignored during the downtime
+    client.available = False
+    age(client, 'odata', 30 * 60)
+
+    assert client.get('/odata') == {'value': 1}
+    wait_for_refresh(client)
+
+    assert client.requests == 2
+    assert client.decode(client.cache['odata']) == {'value': 1}
+
+    # after the downtime, the refresh is synchronous and fails loudly
+    age(client, 'odata', 60 * 60)
+
+    with pytest.raises(RoadworkConnectionError):
+        client.get('/odata')
+
+    # until the backend is available again
+    client.available = True
+    assert client.get('/odata') == {'value': 4}
+    assert client.cache['odata']['created'] > datetime.utcnow() - timedelta(
+        seconds=60)
+
+
+class SharedCache(DictCache):
+    """ A cache shared by multiple processes, with distributed locks. """
+
+    def __init__(self):
+        self.backend = self
+        self.key_mangler = lambda key: f'roadwork:{key}'
+        self.mutexes = {}
+
+    def get_mutex(self, key):
+        return self.mutexes.setdefault(key, Lock())
+
+
+def wait_for_lock(cache, path):
+    key = f'roadwork:refresh-{path}'
+
+    while key not in cache.mutexes or not cache.mutexes[key].locked():
+        sleep(0.01)
+
+
+def test_roadwork_client_single_flight():
+    cache = SharedCache()
+
+    # two processes with the same cache
+    first = FakeClient(cache, 'localhost', 'user', 'pass')
+    first.release.clear()
+
+    second = FakeClient(cache, 'localhost', 'user', 'pass')
+    second.refresh_interval = 0.01
+
+    results = {}
+
+    def get(client):
+        results[client] = client.get('/odata')
+
+    threads = [Thread(target=get, args=(c, )) for c in (first, second)]
+    threads[0].start()
+
+    wait_for_lock(cache, 'odata')
+
+    # the second process waits for the first one
+    threads[1].start()
+
+    while not second.coalesced:
+        sleep(0.01)
+
+    first.release.set()
+
+    for thread in threads:
+        thread.join()
+
+    assert results[first] == results[second] == {'value': 1}
+    assert first.requests == 1
+    assert second.requests == 0
+    assert first.coalesced == 0
+    assert second.coalesced == 1
+
+    # stale values are refreshed by a single process
+    age(first, 'odata', 6 * 60)
+    first.release.clear()
+
+    assert first.get('/odata') == {'value': 1}
+
+    wait_for_lock(cache, 'odata')
+
+    # the other process serves the stale value without refreshing it
+    assert second.get('/odata') == {'value': 1}
+    wait_for_refresh(second)
+
+    assert second.requests == 0
+    assert second.coalesced == 2
+
+    first.release.set()
+    wait_for_refresh(first)
+
+    assert first.requests == 2
+    assert second.get('/odata') == {'value': 2}
+
+
+def test_roadwork_client_single_flight_timeout():
+    cache = SharedCache()
+
+    first = FakeClient(cache, 'localhost', 'user', 'pass')
+    second = FakeClient(cache, 'localhost', 'user', 'pass')
+    second.refresh_interval = 0.01
+    second.refresh_timeout = 0.05
+
+    assert first.get('/odata') == {'value': 1}
+
+    # a refresh which takes longer than the refresh timeout
+    first.release.clear()
+    age(first, 'odata', 2 * 60 * 60)
+
+    thread = Thread(target=first.get, args=('/odata', ), daemon=True)
+    thread.start()
+
+    wait_for_lock(cache, 'odata')
+
+    # the other process serves the cached value, without asking the backend
+    assert second.get('/odata') == {'value': 1}
+    assert second.requests == 0
+    assert second.coalesced == 1
+
+    first.release.set()
+    thread.join()
+
+    assert second.get('/odata') == {'value': 2}
+
+
+def test_roadwork_client_single_flight_without_cache():
+    cache = SharedCache()
+
+    first = FakeClient(cache, 'localhost', 'user', 'pass')
+    first.release.clear()
+
+    second = FakeClient(cache, 'localhost', 'user', 'pass')
+    second.refresh_interval = 0.01
+    second.refresh_timeout = 0.05
+
+    results = {}
+
+    def get(client):
+        try:
+            results[client] = client.get('/odata')
+        except RoadworkConnectionError as e:
+            results[client] = e
+
+    thread = Thread(target=get, args=(first, ), daemon=True)
+    thread.start()
+
+    wait_for_lock(cache, 'odata')
+
+    # without a cached value, the other process waits for the refresh,
+    # even if it takes longer than the refresh timeout
+    waiting = Thread(target=get, args=(second, ), daemon=True)
+    waiting.start()
+
+    sleep(0.2)
+    assert second not in results
+
+    first.release.set()
+
+    for t in (thread, waiting):
+        t.join()
+
+    assert results[first] == results[second] == {'value': 1}
+    assert first.requests == 1
+    assert second.requests == 0
+
+    # if the refresh fails, the backend is asked again, one at a time
+    del cache['odata']
+
+    first.available = False
+    first.release.clear()
+
+    thread = Thread(target=get, args=(first, ), daemon=True)
+    thread.start()
+
+    wait_for_lock(cache, 'odata')
+
+    waiting = Thread(target=get, args=(second, ), daemon=True)
+    waiting.start()
+
+    while not second.coalesced > 1:
+        sleep(0.01)
+
+    assert second.requests == 0
+    first.release.set()
+
+    for t in (thread, waiting):
+        t.join()
+
+    assert isinstance(results[first], RoadworkConnectionError)
+    assert results[second] == {'value': 1}
+    assert second.requests == 1
+
+
+class FakeRedisLock(object):
+
+    def __init__(self, client, key, timeout):
+        self.client = client
+        self.key = key
+        self.timeout = timeout
+        self.token = object()
+
+    def acquire(self, blocking=True):
+        while True:
+            with self.client.lock_:
+                token, expires = self.client.locks.get(self.key, (None, 0))
+
+                if token is None or expires < monotonic():
+                    self.client.locks[self.key] = (
+                        self.token, monotonic() + self.timeout)
+                    return True
+
+            if not blocking:
+                return False
+
+            sleep(0.01)
+
+    def owned(self):
+        token, expires = self.client.locks.get(self.key, (None, 0))
+        return token is self.token and monotonic() <= expires
+
+    def release(self):
+        assert self.owned()
+        del self.client.locks[self.key]
+
+
+class FakeRedis(object):
+
+    def __init__(self):
+        self.locks = {}
+        self.lock_ = Lock()
+
+    def lock(self, key, timeout):
+        return FakeRedisLock(self, key, timeout)
+
+
+class LeasingCache(DictCache):
+    """ A cache shared through redis, with expiring locks. """
+
+    def __init__(self):
+        self.backend = self
+        self.key_mangler = lambda key: f'roadwork:{key}'
+        self.client = FakeRedis()
+
+
+def test_roadwork_client_lease():
+    cache = LeasingCache()
+
+    # a process died while refreshing
+    dead = FakeClient(cache, 'localhost', 'user', 'pass', timeout=0.05)
+    assert dead.refresh_mutex('odata').acquire(False)
+
+    client = FakeClient(cache, 'localhost', 'user', 'pass', timeout=0.05)
+    client.refresh_interval = 0.01
+    assert not client.refresh_mutex('odata').acquire(False)
+
+    # the lock expires after twice the timeout
+    sleep(0.15)
+
+    lock = client.refresh_mutex('odata')
+    assert lock.acquire(False)
+
+    # an expired lease is not released, as it might be held by another
+    sleep(0.15)
+    assert dead.refresh_mutex('odata').acquire(False)
+
+    lock.release()
+    assert 'roadwork:refresh-odata' in cache.client.locks
+
+    # the wait for another process is brief
+    assert client.refresh_timeout <= 2
+
+
+class FakeHandle(object):
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.options = {}
+        self.closed = False
+
+    def setopt(self, key, value):
+        self.options[key] = value
+
+    def perform(self):
+        status, body = self.responses.pop(0)
+
+        if status is None:
+            raise pycurl.error()
+
+        self.status = status
+        self.options[pycurl.WRITEFUNCTION](body)
+
+    def getinfo(self, key):
+        return self.status
+
+    def close(self):
+        self.closed = True
+
+
+class PooledClient(RoadworkClient):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.created = []
+        self.responses = []
+
+    def create_handle(self):
+        self.created.append(FakeHandle(self.responses))
+        return self.created[-1]
+
+
+def test_roadwork_client_pool():
+    client = PooledClient(DictCache(), 'localhost', 'user', 'pass',
+                          pool_size=2)
+
+    # handles are reused
+    client.responses.extend(((200, b'{"id": 1}'), (200, b'{"id": 2}')))
+    assert client.get_uncached('a') == (200, {'id': 1})
+    assert client.get_uncached('b') == (200, {'id': 2})
+    assert len(client.created) == 1
+    assert client.created[0].options[pycurl.URL] == 'http://localhost/b'
+
+    # up to the size of the pool
+    with client.handle() as first:
+        with client.handle() as second:
+            assert first is not second
+
+            borrowed = []
+
+            def borrow():
+                with client.handle() as handle:
+                    borrowed.append(handle)
+
+            thread = Thread(target=borrow)
+            thread.start()
+            thread.join(0.05)
+
+            # the third request waits for a handle
+            assert not borrowed
+
+        thread.join()
+        assert borrowed == [second]
+
+    assert len(client.created) == 2
+
+    # failed handles are replaced
+    client.responses.append((None, b''))
+
+    with pytest.raises(pycurl.error):
+        client.get_uncached('c')
+
+    assert first.closed
+
+    client.responses.extend(((200, b'{"id": 3}'), (200, b'{"id": 4}')))
+
+    with client.handle() as third:
+        with client.handle() as fourth:
+            assert {third, fourth} == {second, client.created[2]}
+
+    assert client.handles == 2
+    assert len(client.created) == 3
+
+
+def test_roadwork_client_pool_failures():
+    client = PooledClient(DictCache(), 'localhost', 'user', 'pass',
+                          pool_size=2)
+
+    failing = Event()
+    borrowed = []
+
+    def fail():
+        with pytest.raises(pycurl.error):
+            with client.handle():
+                borrowed.append(True)
+                failing.wait()
+                raise pycurl.error()
+
+    def wait():
+        with client.handle() as handle:
+            borrowed.append(handle)
+
+    threads = [Thread(target=fail, daemon=True) for _ in range(2)]
+    threads.append(Thread(target=wait, daemon=True))
+
+    for thread in threads[:2]:
+        thread.start()
+
+    while len(borrowed) < 2:
+        sleep(0.01)
+
+    # the third thread waits for a handle
+    threads[2].start()
+    threads[2].join(0.05)
+    assert len(borrowed) == 2
+
+    # once the borrowed handles fail, it creates a new one
+    failing.set()
+
+    for thread in threads:
+        thread.join(5)
+        assert not thread.is_alive()
+
+    assert len(borrowed) == 3
+    assert borrowed[2] is client.created[2]
+    assert client.created[0].closed and client.created[1].closed
+    assert client.handles == 2
+
+
+def test_roadwork_config(tmpdir):
+    path = tmpdir.join('pdb.secret')
+    path.write('\n'.join((
+        'HOSTNAME: pdb.example.org',
+        'ENDPOINT: 127.0.0.1:6004',
+        'USERNAME: username',
+        'PASSWORD: password',
+        'CONNECT_TIMEOUT: 2.5',
+    )))
+
+    config = RoadworkConfig(**RoadworkConfig.parse(Path(str(path))))
+    assert config.hostname == 'pdb.example.org'
+    assert config.connect_timeout == 2.5
+    assert config.timeout == 30
+
+
+def test_roadwork_circuit_breaker():
+    cache = DictCache()
+    client = FakeClient(cache, 'localhost', 'user', 'pass')
+    other = FakeClient(cache, 'localhost', 'user', 'pass')
+
+    assert client.get('/odata') == {'value': 1}
+    assert client.breaker.state == 'closed'
+
+    # the circuit opens after repeated failures
+    client.available = False
+    age(client, 'odata', 2 * 60 * 60)
+
+    for i in range(3):
+        with pytest.raises(RoadworkConnectionError):
+            client.get('/odata')
+
+    assert client.requests == 4
+    assert client.breaker.state == 'open'
+
+    # the state is shared, so no process sends any requests
+    for c in (client, other):
+        with pytest.raises(RoadworkConnectionError) as e:
+            c.get('/odata')
+
+        assert 'repeated failures' in str(e.value)
+
+    assert client.requests == 4
+    assert other.requests == 0
+
+    # after the cool-down, a single probe is sent
+    state = cache['circuit-breaker']
+    state['opened'] -= timedelta(seconds=60)
+
+    assert client.breaker.state == 'half-open'
+
+    with pytest.raises(RoadworkConnectionError):
+        client.get('/odata')
+
+    assert client.requests == 5
+    assert client.breaker.state == 'open'
+
+    # once it succeeds, the circuit closes again
+    cache['circuit-breaker']['opened'] -= timedelta(seconds=60)
+    other.available = True
+
+    assert other.get('/odata') == {'value': 1}
+    assert other.requests == 1
+    assert client.breaker.state == 'closed'
+
+
+def test_roadwork_circuit_breaker_probe():
+    breaker = RoadworkCircuitBreaker(DictCache(), threshold=1, cooldown=30)
+    assert breaker.allow()
+
+    breaker.failure()
+    assert not breaker.allow()
+
+    breaker.cache['circuit-breaker']['opened'] -= timedelta(seconds=60)
+
+    # only the first caller may probe
+    assert breaker.allow()
+    assert not breaker.allow()
+    assert breaker.is_open
+
+    breaker.success()
+    assert breaker.allow()
+    assert breaker.allow()
+
+
+class SlowCache(SharedCache):
+    """ A shared cache with a noticeable delay between reading and writing.
+    """
+
+    def get(self, key):
+        value = super().get(key)
+        sleep(0.01)
+
+        return value
+
+
+def test_roadwork_circuit_breaker_concurrency():
+    cache = SlowCache()
+
+    def run(method, count=10):
+        breakers = [RoadworkCircuitBreaker(cache, threshold=100)
+                    for _ in range(count)]
+        results = []
+
+        threads = [
+            Thread(target=lambda b: results.append(getattr(b, method)()),
+                   args=(b, ))
+            for b in breakers
+        ]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        return results
+
+    # no failure is lost
+    run('failure')
+    assert cache['circuit-breaker']['failures'] == 10
+
+    # only one process may probe
+    cache['circuit-breaker']['opened'] = datetime.utcnow() - timedelta(
+        seconds=60)
+
+    assert sorted(run('allow')) == [False] * 9 + [True]
+
+
+class RoadworkBackend(RoadworkClient):
+
+    def __init__(self, records):
+        super().__init__(DictCache(), 'localhost', 'user', 'pass')
+        self.records = records
+        self.paths = []
+
+    def get_uncached(self, path):
+        self.paths.append(path)
+
+        if path.startswith('odata/Baustellen?'):
+            return 200, {'value': self.records}
+
+        return 200, {'value': []}
+
+
+def roadwork_record(id, title, sections=(), start='2000-01-01', end=None):
+    return {
+        'Id': id,
+        'Internet': True,
+        'ProjektBezeichnung': title,
+        'ProjektBereich': None,
+        'DauerVon': f'{start}T00:00:00+00:00',
+        'DauerBis': end and f'{end}T00:00:00+00:00',
+        'Teilbaustellen': [
+            {
+                'TeilbaustelleId': section_id,
+                'DauerVon': f'{start}T00:00:00+00:00',
+                'DauerBis': section_end and f'{section_end}T00:00:00+00:00',
+            } for section_id, section_end in sections
+        ]
+    }
+
+
+def test_roadwork_section_index():
+    client = RoadworkBackend([
+        roadwork_record(1, "Marktgasse", sections=((11, None), (12, None))),
+        roadwork_record(2, "Obertor", sections=((21, '2001-01-01'), )),
+    ])
+
+    collection = RoadworkCollection(client)
+
+    assert collection.by_id(11).id == 11
+    assert collection.by_id(12).id == 12
+    assert collection.by_id(13) is None
+
+    # sections which are over are not found
+    assert collection.by_id(21) is None
+
+    # the index is built once
+    assert collection.sections is collection.sections
+    assert len(collection.sections) == 3
+    assert sum(1 for p in client.paths if 'filter' in p) == 1
+
+    # and rebuilt once the roadwork is refreshed
+    index = collection.sections
+
+    for entry in client.cache.values():
+        entry['created'] -= timedelta(hours=2)
+
+    client.records.append(roadwork_record(3, "Steinberg", sections=(
+        (31, None), )))
+
+    assert collection.by_id(31).id == 31
+    assert collection.sections is not index
+
+
+def test_roadwork_record():
+    roadwork = Roadwork(roadwork_record(
+        1, " Marktgasse ", sections=((11, None), (12, '2001-01-01'))))
+
+    assert roadwork.id == 1
+    assert roadwork.title == "Marktgasse"
+    assert roadwork.letters == ('m', )
+    assert roadwork['DauerVon'] == roadwork.start
+    assert roadwork['DauerVon'].year == 2000
+    assert roadwork['DauerBis'] is None
+    assert roadwork['Internet'] is True
+    assert 'Internet' in roadwork
+
+    with pytest.raises(KeyError):
+        roadwork['SachbearbeiterBau']
+
+    assert [s.id for s in roadwork.all_sections] == [11, 12]
+    assert [s.id for s in roadwork.sections] == [11]
+    assert roadwork.sections is roadwork.sections
+
+
+def test_roadwork_list_dates(winterthur_app, monkeypatch):
+    records = [
+        roadwork_record(i, f"Strasse {i}", end='2999-12-31', sections=(
+            (i * 10 + s, '2999-12-31') for s in range(3)
+        )) for i in range(300)
+    ]
+
+    winterthur_app.roadwork_client = RoadworkBackend(records)
+
+    parsed = []
+
+    def parse_datetime(value):
+        parsed.append(value)
+        return parse(value)
+
+    parse = isodate.parse_datetime
+    monkeypatch.setattr(isodate, 'parse_datetime', parse_datetime)
+
+    client = Client(winterthur_app)
+
+    page = client.get('/roadwork')
+
+    assert page.pyquery('.roadwork-list > dt').length == 300
+    assert page.pyquery('.roadwork-sections dt').length == 900
+
+    # the dates of each project and section are parsed once
+    assert len(parsed) == (300 + 900) * 2
+
+
+@benchmark
+def test_roadwork_list_benchmark(winterthur_app):
+    records = [
+        roadwork_record(i, f"Strasse {i}", end='2999-12-31', sections=(
+            (i * 10 + s, '2999-12-31') for s in range(3)
+        )) for i in range(300)
+    ]
+
+    winterthur_app.roadwork_client = RoadworkBackend(records)
+
+    client = Client(winterthur_app)
+    timings = {}
+
+    page, timings['first'] = measure(client.get, '/roadwork')
+    assert page.pyquery('.roadwork-list > dt').length == 300
+
+    page, timings['repeated'] = measure(client.get, '/roadwork', repeat=10)
+
+    report("/roadwork (300 projects, 900 sections)", timings)
+
+
+def test_roadwork_snapshot():
+    client = RoadworkBackend([
+        roadwork_record(1, "Obertor"),
+        roadwork_record(2, "Marktgasse"),
+        roadwork_record(3, "Museumstrasse"),
+        {**roadwork_record(4, "Metzggasse"), 'Internet': False},
+    ])
+
+    collection = RoadworkCollection(client)
+    snapshot = collection.snapshot
+
+    assert [r.title for r in collection.roadwork] == [
+        "Marktgasse", "Museumstrasse", "Obertor"]
+    assert collection.letters == ['m', 'o']
+
+    letter = collection.by_letter('M')
+    assert [r.title for r in letter.roadwork] == [
+        "Marktgasse", "Museumstrasse"]
+
+    query = RoadworkCollection(client, query='TOR')
+    assert [r.title for r in query.roadwork] == ["Obertor"]
+
+    # all views share the same snapshot, which is fetched once
+    assert letter.snapshot is query.snapshot is snapshot
+    assert query.roadwork[0] is snapshot.roadwork[2]
+    assert len(client.paths) == 1
+
+
+def test_roadwork_warm():
+    client = RoadworkBackend([
+        roadwork_record(1, "Obertor", sections=((11, None), )),
+        roadwork_record(2, "Marktgasse"),
+        {**roadwork_record(3, "Metzggasse"), 'Internet': False},
+    ])
+
+    collection = RoadworkCollection(client)
+    assert collection.warm(max_workers=2) == 3
+
+    details = sorted(p for p in client.paths if 'filter' not in p)
+    assert details == [
+        'odata/Baustellen(1)?addGisLink=True',
+        'odata/Baustellen(11)?addGisLink=True',
+        'odata/Baustellen(2)?addGisLink=True',
+    ]
+    assert set(client.cache) == {collection.path(collection.active_filter),
+                                 *details}
+
+    # visitors are served from the cache, for projects and sections
+    client.paths.clear()
+    assert collection.by_id(1) is None
+    assert collection.by_id(11).id == 11
+    assert not client.paths
+
+    # each run refreshes all entries
+    assert collection.warm() == 3
+    assert len(client.paths) == 4
+
+    # failures are skipped
+    client.records.clear()
+    client.get_uncached = lambda path: (404, None)
+
+    assert collection.warm() == 0
+
+
+def test_roadwork_cache_format():
+    records = FakePDB(size=200).records
+
+    for record in records:
+        record['GisLink'] = 'https://stadtplan.winterthur.ch/?' + 'x' * 200
+
+        for section in record['Teilbaustellen']:
+            section['Koordinaten'] = [[2697000.0, 1261000.0]] * 10
+
+    client = RoadworkBackend(records)
+    collection = RoadworkCollection(client)
+    path = collection.path(collection.active_filter)
+
+    body = client.get(path)
+
+    # unused fields are not stored
+    assert 'GisLink' not in body['value'][0]
+    assert 'Koordinaten' not in body['value'][0]['Teilbaustellen'][0]
+    assert body['value'][0]['Teilbaustellen'][0]['TeilbaustelleId']
+
+    # the rest is stored compressed
+    entry = client.cache[path]
+    assert 'body' not in entry
+    assert len(entry['data']) * 10 < len(json.dumps({'value': records}))
+
+    # the records are unchanged otherwise
+    assert [r.title for r in collection.roadwork] == sorted(
+        f"{r['ProjektBezeichnung']} {r['ProjektBereich'] or ''}".strip()
+        for r in records if r['Internet']
+    )
+
+    # entries of the previous format are still understood
+    client.cache[path] = {
+        'created': entry['created'],
+        'status': 200,
+        'body': {'value': records}
+    }
+
+    assert client.get(path)['value'][0]['GisLink']
@@ -0,0 +1,136 @@
+import pytest
+
+from datetime import timedelta
+from onegov.winterthur.roadwork import RoadworkCollection
+from onegov.winterthur.tests.benchmark import benchmark, measure, report
+from onegov_testing import Client
+from time import sleep
+
+
+def cached_paths(app):
+    collection = RoadworkCollection(app.roadwork_client)
+
+    yield collection.path(collection.active_filter)
+
+    for id in range(1, 11):
+        yield collection.detail_path(id)
+
+
+def age(app, seconds):
+    cache = app.roadwork_client.cache
+
+    for path in cached_paths(app):
+        entry = cache.get(path)
+
+        if entry:
+            entry['created'] -= timedelta(seconds=seconds)
+            cache.set(path, entry)
+
+
+def wait_for_refresh(app):
+    while app.roadwork_client.refreshing:
+        sleep(0.01)
+
+
+@pytest.mark.parametrize('url', ['/roadwork', '/roadwork/1'])
+def test_roadwork_fake_pdb(roadwork_app, fake_pdb, url):
+    client = Client(roadwork_app)
+
+    # the first request waits for the backend
+    page = client.get(url)
+    assert "Abschnitt" in page or "Muster Max" in page
+    assert fake_pdb.requests > 0
+
+    # the following requests are served from the cache
+    requests = fake_pdb.requests
+
+    client.get(url)
+    assert fake_pdb.requests == requests
+
+    # stale values are served while they are refreshed in the background,
+    # so the response does not wait for the held back backend
+    fake_pdb.open.clear()
+    age(roadwork_app, 10 * 60)
+
+    page = client.get(url)
+    assert "Abschnitt" in page or "Muster Max" in page
+    assert roadwork_app.roadwork_client.refreshing
+
+    fake_pdb.open.set()
+    wait_for_refresh(roadwork_app)
+
+    assert fake_pdb.requests > requests
+
+    # stale values are served while the backend is down
+    requests = fake_pdb.requests
+    fake_pdb.down = True
+    age(roadwork_app, 10 * 60)
+
+    page = client.get(url)
+    assert "Abschnitt" in page or "Muster Max" in page
+
+    wait_for_refresh(roadwork_app)
+    assert fake_pdb.requests > requests
+
+    # once the downtime is up, the backend is asked and the error page shown
+    requests = fake_pdb.requests
+    age(roadwork_app, 2 * 60 * 60)
+
+    page = client.get(url, status=500)
+    assert "Verbindungsfehler" in page
+    assert fake_pdb.requests > requests
+
+    # until the circuit breaker opens, after which the backend is left alone
+    while not roadwork_app.roadwork_client.breaker.is_open:
+        client.get(url, status=500)
+
+    requests = fake_pdb.requests
+
+    page = client.get(url, status=500)
+    assert "Verbindungsfehler" in page
+    assert fake_pdb.requests == requests
+
+
+def test_roadwork_fake_pdb_errors(roadwork_app, fake_pdb):
+    client = Client(roadwork_app)
+    fake_pdb.error_rate = 1.0
+
+    client.get('/roadwork', status=500)
+    assert fake_pdb.requests == 1
+
+    fake_pdb.error_rate = 0.0
+
+    page = client.get('/roadwork')
+    assert page.pyquery('.roadwork-list > dt').length == sum(
+        1 for r in fake_pdb.records if r['Internet'])
+
+
+@benchmark
+@pytest.mark.parametrize('url', ['/roadwork', '/roadwork/1'])
+def test_roadwork_benchmark(roadwork_app, fake_pdb, url):
+    client = Client(roadwork_app)
+    timings = {}
+
+    fake_pdb.latency = 0.25
+
+    # the first request waits for the backend
+    page, timings['cold'] = measure(client.get, url)
+    assert "Abschnitt" in page or "Muster Max" in page
+
+    # the following requests are served from the cache
+    page, timings['warm'] = measure(client.get, url)
+
+    # stale values are served while they are refreshed in the background
+    age(roadwork_app, 10 * 60)
+
+    page, timings['stale'] = measure(client.get, url)
+    wait_for_refresh(roadwork_app)
+
+    # stale values are served while the backend is down
+    fake_pdb.down = True
+    age(roadwork_app, 10 * 60)
+
+    page, timings['down'] = measure(client.get, url)
+    wait_for_refresh(roadwork_app)
+
+    report(f"{url} (backend latency: {fake_pdb.latency}s)", timings)
@@ -1,5 +1,8 @@
 import transaction
 
+from decimal import Decimal
+from onegov.core.csv import CSVFile
+from onegov.org.models import Organisation
 from onegov.winterthur.collections import AddressCollection
 from onegov_testing import Client as BaseClient
 
@@ -28,3 +31,138 @@ def test_view_addresses(winterthur_app, streets_csv, addresses_csv):
     assert "Zürcherstrasse 100" in page
     assert "Schlosstal" in page
     assert "Töss" in page
+
+
+def test_view_addresses_cache(winterthur_app, fixtures):
+
+    def import_addresses(collection):
+        with (fixtures / 'streets.csv').open('rb') as streets:
+            with (fixtures / 'addresses.csv').open('rb') as addresses:
+                return collection.sync_from_csv(
+                    CSVFile(streets), CSVFile(addresses))
+
+    client = Client(winterthur_app)
+
+    transaction.begin()
+    import_addresses(AddressCollection(
+        winterthur_app.session(), cache=winterthur_app.streets_cache))
+    transaction.commit()
+
+    assert "Zürcherstrasse" in client.get('/streets')
+
+    # the listing is cached
+    transaction.begin()
+    AddressCollection(winterthur_app.session()).query()\
+        .filter_by(street="Zürcherstrasse")\
+        .delete()
+    transaction.commit()
+
+    assert "Zürcherstrasse" in client.get('/streets')
+
+    # changes made through the collection invalidate the listing
+    transaction.begin()
+    changes = import_addresses(AddressCollection(
+        winterthur_app.session(), cache=winterthur_app.streets_cache))
+    transaction.commit()
+
+    assert changes['added'] > 0
+    assert "Zürcherstrasse 100" in client.get('/streets').click(
+        "Zürcherstrasse")
+
+    transaction.begin()
+    AddressCollection(
+        winterthur_app.session(), cache=winterthur_app.streets_cache
+    ).delete_existing()
+    transaction.commit()
+
+    assert "Keine Strassen gefunden" in client.get('/streets')
+
+
+def test_view_daycare_settings_preview(daycare_app):
+    client = Client(daycare_app)
+
+    def preview_form():
+        form = client.get('/daycare-settings').form
+        form.action = '/daycare-settings-preview'
+
+        return form
+
+    # only admins may preview the settings
+    client.post('/daycare-settings-preview', status=403)
+
+    client.login_editor()
+    client.post('/daycare-settings-preview', status=403)
+    client.logout()
+
+    client.login_admin()
+
+    # without changes, there is no impact
+    summary = preview_form().submit().json
+    assert summary['total']['households'] == 7 * 101 * 5
+    assert summary['total']['changed'] == 0
+    assert len(summary['daycares']) == 7
+
+    # raising the maximum income raises the city share
+    form = preview_form()
+    form['max_income'] = '80000'
+
+    summary = form.submit().json
+    assert summary['total']['changed'] > 0
+    assert Decimal(summary['total']['min']) == 0
+    assert Decimal(summary['total']['max']) > 0
+
+    # invalid settings are rejected
+    form = preview_form()
+    form['max_income'] = ''
+    assert 'max_income' in form.submit(status=400).json['errors']
+
+    form = preview_form()
+    form['max_income'] = form['min_income'].value
+    assert 'max_income' in form.submit(status=400).json['errors']
+
+    # without stored settings, there is nothing to compare with
+    form = preview_form()
+
+    transaction.begin()
+    org = daycare_app.session().query(Organisation).one()
+    del org.meta['daycare_settings']
+    transaction.commit()
+
+    assert 'settings' in form.submit(status=400).json['errors']
+
+
+def test_view_daycare_comparison(daycare_app):
+    client = Client(daycare_app)
+
+    page = client.get('/daycare-subsidy-calculator')
+    assert 'daycare' in page.form.fields
+
+    page = page.click("Alle Kitas vergleichen")
+    assert "Kita Vergleich" in page
+
+    # the household is entered once, without choosing a daycare
+    form = page.form
+    assert 'daycare' not in form.fields
+
+    form['income'] = '75000'
+    form['wealth'] = '150000'
+
+    for checkbox in form.fields['services']:
+        if checkbox._value == 'ganzer-tag-inkl-mitagessen-0':
+            checkbox.checked = True
+
+    page = form.submit()
+
+    titles = [td.text for td in page.pyquery('.daycare-comparison tbody td')]
+    assert sorted(titles[::4]) == [
+        "Am Park",
+        "Apfelblüte",
+        "Child Care Corner",
+        "Fantasia",
+        "Kinderhaus",
+        "Luftibus",
+        "Pinochio",
+    ]
+
+    page = page.click("Beitrag für eine einzelne Kita berechnen")
+    assert 'daycare' in page.form.fields
@@ -2,7 +2,9 @@ from onegov.core.security import Public
 from onegov.winterthur import WinterthurApp, _
 from onegov.winterthur.daycare import DaycareSubsidyCalculator
 from onegov.winterthur.daycare import DaycareSubsidyCalculatorForm
+from onegov.winterthur.daycare import DaycareSubsidyComparisonForm
 from onegov.winterthur.layout import DaycareSubsidyCalculatorLayout
+from onegov.winterthur.layout import DaycareSubsidyComparisonLayout
 
 
 @WinterthurApp.form(
@@ -29,7 +31,35 @@ def view_daycare_subsidy_calculator(self, request, form):
         'calculation': calculation,
         'button_text': _("Calculate"),
         'settings': self.settings,
+        'comparison_link': request.link(self, name='compare'),
         'eligible': (
             calculation and calculation.city_share_per_month != '0.00'
         )
     }
+
+
+@WinterthurApp.form(
+    model=DaycareSubsidyCalculator,
+    name='compare',
+    form=DaycareSubsidyComparisonForm,
+    permission=Public,
+    template='daycare_comparison.pt')
+def view_daycare_subsidy_comparison(self, request, form):
+    comparison = None
+
+    if form.submitted(request):
+        comparison = self.compare(
+            services=form.services.services,
+            income=form.income.data,
+            wealth=form.wealth.data,
+            rebate=form.rebate.data
+        )
+
+    return {
+        'title': _("Daycare Comparison"),
+        'layout': DaycareSubsidyComparisonLayout(self, request),
+        'form': form,
+        'comparison': comparison,
+        'button_text': _("Compare"),
+        'calculator_link': request.link(self),
+    }
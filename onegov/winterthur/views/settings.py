@@ -1,5 +1,6 @@
 import textwrap
 
+from decimal import Decimal
 from onegov.core.security import Secret
 from onegov.directory import Directory, DirectoryCollection
 from onegov.form import Form
@@ -8,7 +9,11 @@ from onegov.org.models import Organisation
 from onegov.org.views.settings import handle_generic_settings
 from onegov.winterthur import _
 from onegov.winterthur.app import WinterthurApp
+from onegov.winterthur.daycare import DaycareSubsidyCalculator
 from onegov.winterthur.daycare import Services
+from onegov.winterthur.daycare import Settings
+from onegov.winterthur.daycare import SettingsImpact
+from onegov.winterthur.daycare import calculation_cache
 from wtforms.fields import RadioField, TextAreaField
 from wtforms.fields.html5 import DecimalField
 from wtforms.validators import InputRequired, ValidationError
@@ -103,6 +108,14 @@ class WinterthurDaycareSettingsForm(Form):
                 #   prozent: 100.00
             """)
 
+    def validate_max_income(self, field):
+        if field.data is None or self.min_income.data is None:
+            return
+
+        if field.data <= self.min_income.data:
+            raise ValidationError(
+                _("The maximum income must be higher than the minimum income"))
+
     def validate_services(self, field):
         try:
             tuple(Services.parse_definition(field.data))
@@ -131,4 +144,71 @@ class WinterthurDaycareSettingsForm(Form):
                     setting=_("Daycare Calculator"),
                     icon='fa-calculator')
 def custom_handle_settings(self, request, form):
+    if form.submitted(request):
+        calculation_cache.invalidate()
+
     return handle_generic_settings(self, request, form, _("Daycare Settings"))
+
+
+def as_json(value):
+    if isinstance(value, dict):
+        return {k: as_json(v) for k, v in value.items()}
+
+    if isinstance(value, (list, tuple)):
+        return [as_json(v) for v in value]
+
+    if isinstance(value, Decimal):
+        return str(value)
+
+    return value
+
+
+@WinterthurApp.json(model=Organisation, name='daycare-settings-preview',
+                    permission=Secret, request_method='POST')
+def preview_daycare_settings(self, request):
+    """ Compares the submitted settings with the current settings, returning
+    the distribution of the changes to the monthly city share.
+
+    """
+    form = request.get_form(WinterthurDaycareSettingsForm, model=self)
+
+    def bad_request(errors):
+
+        @request.after
+        def set_status(response):
+            response.status_code = 400
+
+        return {'errors': errors}
+
+    if not form.validate():
+        return bad_request(form.errors)
+
+    calculator = DaycareSubsidyCalculator(
+        request.session, cache=request.app.daycare_cache)
+
+    # without stored settings, there is nothing to compare with
+    old = calculator.settings
+
+    if not old.is_valid():
+        return bad_request({'settings': [
+            request.translate(_("No daycare settings have been stored yet"))
+        ]})
+
+    # the daycares the current settings apply to
+    daycares = calculator.daycares.values()
+
+    new = Settings(settings={
+        k: v for k, v in form.data.items() if k != 'csrf_token'
+    })
+
+    impact = SettingsImpact(old, new, daycares)
+
+    # the stored settings were not necessarily validated the same way
+    try:
+        summary = impact.summary()
+    except ArithmeticError:
+        return bad_request({'settings': [
+            request.translate(_("The daycare settings cannot be compared"))
+        ]})
+
+    return as_json(summary)
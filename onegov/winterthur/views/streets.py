@@ -1,5 +1,3 @@
-from itertools import groupby
-from onegov.core.cache import lru_cache
 from onegov.core.security import Public, Private
 from onegov.winterthur import WinterthurApp, _
 from onegov.winterthur.collections import AddressCollection
@@ -17,21 +15,13 @@ from urllib.parse import quote_plus
 def view_streets(self, request):
     request.include('street-search')
 
-    by_letter = {
-        letter: tuple(streets) for letter, streets in groupby(
-            self.streets(), lambda s: s.letter
-        )
-    }
-
-    @lru_cache(maxsize=1)
     def link_to_street(street):
         return request.class_link(AddressSubsetCollection, {'street': street})
 
     return {
         'layout': AddressLayout(self, request),
         'title': _("Streets Directory"),
-        'streets': by_letter,
-        'link_to_street': link_to_street
+        'streets': dict(self.listing(request.application_url, link_to_street))
     }
 
 